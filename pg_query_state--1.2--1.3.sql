@@ -0,0 +1,70 @@
+-- complain if script is sourced in psql, rather than via CREATE EXTENSION
+\echo Use "ALTER EXTENSION pg_query_state UPDATE TO '1.3'" to load this file. \quit
+
+DROP FUNCTION pg_query_state(integer, boolean, boolean, boolean, boolean, boolean, text);
+
+CREATE FUNCTION pg_query_state(pid 		integer
+							 , verbose	boolean = FALSE
+							 , costs 	boolean = FALSE
+							 , timing 	boolean = FALSE
+							 , buffers 	boolean = FALSE
+							 , triggers	boolean = FALSE
+						     , format	text = 'text'
+							 , frame	text = 'all'
+							 , node_id	integer = -1
+							 , depth	integer = -1
+							 , memory	boolean = FALSE
+							 , progress	boolean = FALSE)
+	RETURNS TABLE (pid integer
+				 , frame_number integer
+				 , query_text text
+				 , plan text
+				 , leader_pid integer)
+	AS 'MODULE_PATHNAME'
+	LANGUAGE C STRICT VOLATILE;
+
+CREATE FUNCTION pg_query_state_watch(pid		integer
+									, delay	float8 = 1)
+	RETURNS TABLE (ts timestamp with time zone
+				 , progress float8
+				 , rows_processed float8
+				 , rows_per_sec float8
+				 , workers integer
+				 , worker_pids integer[]
+				 , worker_rows float8[])
+	AS 'MODULE_PATHNAME'
+	LANGUAGE C STRICT VOLATILE;
+
+CREATE FUNCTION pg_query_state_misestimates(pid		integer
+										   , factor	float8 = 10)
+	RETURNS TABLE (frame_number integer
+				 , plan_node_id integer
+				 , node_type text
+				 , relid oid
+				 , relation text
+				 , plan_rows float8
+				 , loops float8
+				 , actual_rows float8
+				 , rows_removed float8
+				 , misestimate float8)
+	AS 'MODULE_PATHNAME'
+	LANGUAGE C STRICT VOLATILE;
+
+CREATE FUNCTION pg_query_progress()
+	RETURNS TABLE (pid integer
+				 , datid oid
+				 , usesysid oid
+				 , query_id bigint
+				 , query_start timestamp with time zone
+				 , updated_at timestamp with time zone
+				 , progress float8
+				 , workers integer
+				 , node_ids integer[]
+				 , node_rows float8[])
+	AS 'MODULE_PATHNAME'
+	LANGUAGE C STRICT VOLATILE;
+
+CREATE VIEW pg_query_progress AS
+	SELECT * FROM pg_query_progress();
+
+GRANT SELECT ON pg_query_progress TO PUBLIC;
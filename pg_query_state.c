@@ -11,6 +11,7 @@
 #include "pg_query_state.h"
 
 #include "access/htup_details.h"
+#include "access/parallel.h"
 #include "catalog/pg_type.h"
 #include "funcapi.h"
 #include "executor/execParallel.h"
@@ -26,7 +27,11 @@
 #include "storage/procarray.h"
 #include "storage/procsignal.h"
 #include "storage/shm_toc.h"
+#include "utils/array.h"
+#include "utils/builtins.h"
 #include "utils/guc.h"
+#include "utils/lsyscache.h"
+#include "utils/memutils.h"
 #include "utils/timestamp.h"
 
 #ifdef PG_MODULE_MAGIC
@@ -36,10 +41,31 @@ PG_MODULE_MAGIC;
 #define TEXT_CSTR_CMP(text, cstr) \
 	(memcmp(VARDATA(text), (cstr), VARSIZE(text) - VARHDRSZ))
 
+/*
+ * pg_progress_bar needs only "Query Progress" of the plan, so ask for the
+ * top plan node alone where depth limit is supported
+ */
+#if PG_VERSION_NUM >= 130000
+#define PROGRESS_PLAN_DEPTH	0
+#else
+#define PROGRESS_PLAN_DEPTH	(-1)
+#endif
+
 /* GUC variables */
 bool pg_qs_enable = true;
 bool pg_qs_timing = false;
 bool pg_qs_buffers = false;
+int pg_qs_log_on_cancel = PG_QS_LOG_ON_CANCEL_OFF;
+int pg_qs_log_on_cancel_max_size = 64;
+int pg_qs_timing_sample_rate = 0;
+int pg_qs_progress_update_interval = 0;
+
+static const struct config_enum_entry log_on_cancel_options[] = {
+	{"off", PG_QS_LOG_ON_CANCEL_OFF, false},
+	{"text", EXPLAIN_FORMAT_TEXT, false},
+	{"json", EXPLAIN_FORMAT_JSON, false},
+	{NULL, 0, false}
+};
 
 /* Saved hook values in case of unload */
 static ExecutorStart_hook_type prev_ExecutorStart = NULL;
@@ -58,6 +84,11 @@ static void qs_ExecutorRun(QueryDesc *queryDesc, ScanDirection direction,
 						   uint64 count, bool execute_once);
 #endif
 static void qs_ExecutorFinish(QueryDesc *queryDesc);
+static void log_interrupted_query(QueryDesc *queryDesc);
+#if PG_VERSION_NUM >= 100000
+static bool install_sampled_timing(PlanState *node, void *context);
+static TupleTableSlot *qs_ExecProcNodeSampled(PlanState *node);
+#endif
 
 static shm_mq_result receive_msg_by_parts(shm_mq_handle *mqh, Size *total,
 											 void **datap, int64 timeout, int *rc, bool nowait);
@@ -69,6 +100,7 @@ ProcSignalReason QueryStatePollReason = INVALID_PROCSIGNAL;
 ProcSignalReason WorkerPollReason = INVALID_PROCSIGNAL;
 static bool				module_initialized = false;
 static int              reqid = 0;
+static bool				interrupted_query_logged = false;
 
 static void SendBgWorkerPids(void);
 static Oid GetRemoteBackendUserId(PGPROC *proc);
@@ -80,7 +112,13 @@ static List *GetRemoteBackendQueryStates(PGPROC *leader,
 										 bool timing,
 										 bool buffers,
 										 bool triggers,
-										 ExplainFormat format);
+										 ExplainFormat format,
+										 int frame,
+										 int node_id,
+										 int depth,
+										 bool memory,
+										 bool progress,
+										 bool counters);
 static shm_mq_result shm_mq_receive_with_timeout(shm_mq_handle *mqh,
 										 Size *nbytesp,
 										 void **datap,
@@ -115,11 +153,12 @@ pg_qs_shmem_size()
 
 	shm_toc_initialize_estimator(&e);
 
-	nkeys = 3;
+	nkeys = 4;
 
 	shm_toc_estimate_chunk(&e, sizeof(pg_qs_params));
 	shm_toc_estimate_chunk(&e, (Size) QUEUE_SIZE);
 	shm_toc_estimate_chunk(&e, sizeof(uint32));
+	shm_toc_estimate_chunk(&e, ProgressSlotsShmemSize());
 
 	shm_toc_estimate_keys(&e, nkeys);
 	size = shm_toc_estimate(&e);
@@ -153,6 +192,10 @@ pg_qs_shmem_startup(void)
 		mq_req_id = shm_toc_allocate(toc, sizeof(uint32));
 		shm_toc_insert(toc, num_toc++, mq_req_id);
 		*mq_req_id = 0;
+
+		progress_slots = shm_toc_allocate(toc, ProgressSlotsShmemSize());
+		shm_toc_insert(toc, num_toc++, progress_slots);
+		MemSet(progress_slots, 0, ProgressSlotsShmemSize());
 	}
 	else
 	{
@@ -162,10 +205,12 @@ pg_qs_shmem_startup(void)
 		params = shm_toc_lookup(toc, num_toc++);
 		mq = shm_toc_lookup(toc, num_toc++);
 		mq_req_id = shm_toc_lookup(toc, num_toc++);
+		progress_slots = shm_toc_lookup(toc, num_toc++);
 #else
 		params = shm_toc_lookup(toc, num_toc++, false);
 		mq = shm_toc_lookup(toc, num_toc++, false);
 		mq_req_id = shm_toc_lookup(toc, num_toc++, false);
+		progress_slots = shm_toc_lookup(toc, num_toc++, false);
 #endif
 	}
 	LWLockRelease(AddinShmemInitLock);
@@ -241,6 +286,53 @@ _PG_init(void)
 							 NULL,
 							 NULL,
 							 NULL);
+	DefineCustomEnumVariable("pg_query_state.log_on_cancel",
+							 "Write state of query interrupted by cancel request or timeout to server log.",
+							 "Valid values are \"off\", \"text\" and \"json\".",
+							 &pg_qs_log_on_cancel,
+							 PG_QS_LOG_ON_CANCEL_OFF,
+							 log_on_cancel_options,
+							 PGC_SUSET,
+							 0,
+							 NULL,
+							 NULL,
+							 NULL);
+	DefineCustomIntVariable("pg_query_state.log_on_cancel_max_size",
+							"Maximum size of query state written to server log.",
+							NULL,
+							&pg_qs_log_on_cancel_max_size,
+							64,
+							1,
+							MaxAllocSize / 1024 / 2,
+							PGC_SUSET,
+							GUC_UNIT_KB,
+							NULL,
+							NULL,
+							NULL);
+	DefineCustomIntVariable("pg_query_state.timing_sample_rate",
+							"Time only every Nth row of plan node and extrapolate the rest.",
+							"Values 0 and 1 mean that every row is timed.",
+							&pg_qs_timing_sample_rate,
+							0,
+							0,
+							INT_MAX,
+							PGC_SUSET,
+							0,
+							NULL,
+							NULL,
+							NULL);
+	DefineCustomIntVariable("pg_query_state.progress_update_interval",
+							"Interval of publishing query progress to shared memory.",
+							"Zero turns publishing off.",
+							&pg_qs_progress_update_interval,
+							0,
+							0,
+							INT_MAX,
+							PGC_SUSET,
+							GUC_UNIT_MS,
+							NULL,
+							NULL,
+							NULL);
 	EmitWarningsOnPlaceholders("pg_query_state");
 
 	/* Install hooks */
@@ -272,12 +364,23 @@ pg_qs_shmem_request(void)
 static void
 qs_ExecutorStart(QueryDesc *queryDesc, int eflags)
 {
+	bool	sample_timing = false;
+
 	/* Enable per-node instrumentation */
 	if (pg_qs_enable && ((eflags & EXEC_FLAG_EXPLAIN_ONLY) == 0))
 	{
 		queryDesc->instrument_options |= INSTRUMENT_ROWS;
 		if (pg_qs_timing)
-			queryDesc->instrument_options |= INSTRUMENT_TIMER;
+		{
+#if PG_VERSION_NUM >= 100000
+			/* Don't degrade timing that is requested by EXPLAIN ANALYZE */
+			if (pg_qs_timing_sample_rate > 1
+				&& (queryDesc->instrument_options & INSTRUMENT_TIMER) == 0)
+				sample_timing = true;
+			else
+#endif
+				queryDesc->instrument_options |= INSTRUMENT_TIMER;
+		}
 		if (pg_qs_buffers)
 			queryDesc->instrument_options |= INSTRUMENT_BUFFERS;
 	}
@@ -286,6 +389,179 @@ qs_ExecutorStart(QueryDesc *queryDesc, int eflags)
 		prev_ExecutorStart(queryDesc, eflags);
 	else
 		standard_ExecutorStart(queryDesc, eflags);
+
+#if PG_VERSION_NUM >= 100000
+	if (sample_timing && queryDesc->planstate)
+		install_sampled_timing(queryDesc->planstate, NULL);
+#endif
+}
+
+#if PG_VERSION_NUM >= 100000
+/*
+ * Add interval multiplied by weight to accumulated time
+ */
+static inline void
+instr_time_add_scaled(instr_time *sum, instr_time interval, int weight)
+{
+	while (weight > 0)
+	{
+		if (weight & 1)
+			INSTR_TIME_ADD(*sum, interval);
+		INSTR_TIME_ADD(interval, interval);
+		weight >>= 1;
+	}
+}
+
+/*
+ * Replace ExecProcNode of every instrumented node without timer by wrapper
+ * that collects sampled timing.
+ */
+static bool
+install_sampled_timing(PlanState *node, void *context)
+{
+	if (node == NULL)
+		return false;
+
+	if (node->instrument && !node->instrument->need_timer)
+		node->ExecProcNode = qs_ExecProcNodeSampled;
+
+	return planstate_tree_walker(node, install_sampled_timing, context);
+}
+
+/*
+ * Check whether node times are estimated from samples
+ */
+bool
+IsTimingSampled(PlanState *planstate)
+{
+	return planstate != NULL && planstate->ExecProcNode == qs_ExecProcNodeSampled;
+}
+
+/*
+ * ExecProcNode wrapper for sampled timing:
+ *		Read the clock only on the first call of each loop, which carries
+ *		startup cost of node, and on every Nth call after it. Time of sampled
+ *		call is accounted as time of N calls. Rows and buffers are counted
+ *		the usual way.
+ */
+static TupleTableSlot *
+qs_ExecProcNodeSampled(PlanState *node)
+{
+	Instrumentation	   *instr = node->instrument;
+	TupleTableSlot	   *result;
+	int					rate = Max(pg_qs_timing_sample_rate, 1);
+	int					weight;
+	instr_time			starttime;
+	instr_time			endtime;
+
+	if (ProgressUpdatePending)
+		UpdateProgressSlot();
+
+	if (!instr->running)
+	{
+		/* the same check as in ExecProcNodeFirst that we have replaced */
+		check_stack_depth();
+		weight = 1;
+	}
+	else if ((uint64) instr->tuplecount % rate == 0)
+		weight = rate;
+	else
+		weight = 0;
+
+	if (weight == 0)
+	{
+		InstrStartNode(instr);
+		result = node->ExecProcNodeReal(node);
+		InstrStopNode(instr, TupIsNull(result) ? 0.0 : 1.0);
+		return result;
+	}
+
+	INSTR_TIME_SET_CURRENT(starttime);
+	InstrStartNode(instr);
+
+	/*
+	 * InstrStartNode doesn't set start time of node without timer, set it for
+	 * runtime EXPLAIN to count time of the call in progress, e.g. of the first
+	 * call of Sort or Hash that consumes the whole input
+	 */
+	instr->starttime = starttime;
+	result = node->ExecProcNodeReal(node);
+	INSTR_TIME_SET_CURRENT(endtime);
+	INSTR_TIME_SET_ZERO(instr->starttime);
+
+	/* account time before InstrStopNode to get startup time of loop right */
+	INSTR_TIME_SUBTRACT(endtime, starttime);
+	instr_time_add_scaled(&instr->counter, endtime, weight);
+	InstrStopNode(instr, TupIsNull(result) ? 0.0 : 1.0);
+
+	return result;
+}
+#else
+bool
+IsTimingSampled(PlanState *planstate)
+{
+	return false;
+}
+#endif
+
+/*
+ * Write state of query to server log if it's being interrupted by cancel
+ * request, statement_timeout or lock_timeout.
+ *		Called from PG_CATCH blocks of executor hooks after queryDesc is popped
+ *		from QueryDescStack. Only the innermost frame that catches the error
+ *		logs the whole stack, outer frames see the same error and skip it.
+ */
+static void
+log_interrupted_query(QueryDesc *queryDesc)
+{
+	MemoryContext	oldcontext;
+	ErrorData	   *edata;
+
+	if (!pg_qs_enable
+		|| pg_qs_log_on_cancel == PG_QS_LOG_ON_CANCEL_OFF
+		|| interrupted_query_logged
+		|| IsParallelWorker()
+		|| queryDesc->estate == NULL
+		|| queryDesc->planstate == NULL)
+		return;
+
+	interrupted_query_logged = true;
+
+	/* we are in ErrorContext here, copy error data out of it */
+	oldcontext = MemoryContextSwitchTo(queryDesc->estate->es_query_cxt);
+	edata = CopyErrorData();
+
+	if (edata->sqlerrcode == ERRCODE_QUERY_CANCELED
+		|| edata->sqlerrcode == ERRCODE_LOCK_NOT_AVAILABLE)
+	{
+		uint32	holdoff = InterruptHoldoffCount;
+
+		/*
+		 * Error raised while printing would replace the original one, so
+		 * logging failure is dropped and the original error is thrown again
+		 */
+		PG_TRY();
+		{
+			/* error recovery has reset holdoff, don't let another cancel in */
+			HOLD_INTERRUPTS();
+			LogQueryState(lcons(queryDesc, QueryDescStack),
+						  (ExplainFormat) pg_qs_log_on_cancel,
+						  pg_qs_log_on_cancel_max_size * 1024,
+						  edata->message ? edata->message : "");
+			RESUME_INTERRUPTS();
+		}
+		PG_CATCH();
+		{
+			InterruptHoldoffCount = holdoff;
+			MemoryContextSwitchTo(queryDesc->estate->es_query_cxt);
+			FlushErrorState();
+			ReThrowError(edata);
+		}
+		PG_END_TRY();
+	}
+
+	FreeErrorData(edata);
+	MemoryContextSwitchTo(oldcontext);
 }
 
 /*
@@ -300,7 +576,12 @@ qs_ExecutorRun(QueryDesc *queryDesc, ScanDirection direction, uint64 count,
 			   bool execute_once)
 #endif
 {
+	bool	outermost = (QueryDescStack == NIL);
+
+	if (outermost)
+		StartProgressReport(queryDesc);
 	QueryDescStack = lcons(queryDesc, QueryDescStack);
+	interrupted_query_logged = false;
 
 	PG_TRY();
 	{
@@ -319,9 +600,15 @@ qs_ExecutorRun(QueryDesc *queryDesc, ScanDirection direction, uint64 count,
 	PG_CATCH();
 	{
 		QueryDescStack = list_delete_first(QueryDescStack);
+		if (outermost)
+			StopProgressReport();
+		log_interrupted_query(queryDesc);
 		PG_RE_THROW();
 	}
 	PG_END_TRY();
+
+	if (outermost)
+		StopProgressReport();
 }
 
 /*
@@ -332,6 +619,7 @@ static void
 qs_ExecutorFinish(QueryDesc *queryDesc)
 {
 	QueryDescStack = lcons(queryDesc, QueryDescStack);
+	interrupted_query_logged = false;
 
 	PG_TRY();
 	{
@@ -344,6 +632,7 @@ qs_ExecutorFinish(QueryDesc *queryDesc)
 	PG_CATCH();
 	{
 		QueryDescStack = list_delete_first(QueryDescStack);
+		log_interrupted_query(queryDesc);
 		PG_RE_THROW();
 	}
 	PG_END_TRY();
@@ -443,6 +732,7 @@ LockShmem(LOCKTAG *tag, uint32 key)
  */
 typedef struct
 {
+	int		 frame_number;
 	text	*query;
 	text	*plan;
 } stack_frame;
@@ -455,9 +745,10 @@ static stack_frame *
 deserialize_stack_frame(char **src)
 {
 	stack_frame *result = palloc(sizeof(stack_frame));
-	text		*query = (text *) *src,
-				*plan = (text *) (*src + INTALIGN(VARSIZE(query)));
+	text		*query = (text *) (*src + sizeof(int)),
+				*plan = (text *) ((char *) query + INTALIGN(VARSIZE(query)));
 
+	memcpy(&result->frame_number, *src, sizeof(int));
 	result->query = palloc(VARSIZE(query));
 	memcpy(result->query, query, VARSIZE(query));
 	result->plan = palloc(VARSIZE(plan));
@@ -497,7 +788,6 @@ pg_query_state(PG_FUNCTION_ARGS)
 	{
 		PGPROC 		*proc;
 		ListCell 	*frame_cursor;
-		int			 frame_index;
 		List		*stack;
 	} proc_state;
 
@@ -524,6 +814,11 @@ pg_query_state(PG_FUNCTION_ARGS)
 						 triggers = PG_GETARG_BOOL(5);
 		text			*format_text = PG_GETARG_TEXT_P(6);
 		ExplainFormat	 format;
+		int				 frame = PG_QS_FRAME_ALL,
+						 node_id = -1,
+						 depth = -1;
+		bool			 memory = false,
+						 progress = false;
 		PGPROC			*proc;
 		Oid				 counterpart_user_id;
 		shm_mq_msg		*msg;
@@ -561,6 +856,52 @@ pg_query_state(PG_FUNCTION_ARGS)
 		else
 			ereport(ERROR, (errcode(ERRCODE_INVALID_PARAMETER_VALUE),
 							errmsg("unrecognized 'format' argument")));
+
+		/* arguments added in 1.3, absent if extension isn't updated yet */
+		if (PG_NARGS() > 7)
+		{
+			char	*frame_str = text_to_cstring(PG_GETARG_TEXT_PP(7));
+			char	*endptr;
+			long	 frame_num;
+
+			if (strcmp(frame_str, "all") == 0)
+				frame = PG_QS_FRAME_ALL;
+			else if (strcmp(frame_str, "outermost") == 0)
+				frame = 0;
+			else if (strcmp(frame_str, "innermost") == 0)
+				frame = PG_QS_FRAME_INNERMOST;
+			else
+			{
+				errno = 0;
+				frame_num = strtol(frame_str, &endptr, 10);
+				if (endptr == frame_str || *endptr != '\0' || errno != 0
+					|| frame_num < 0 || frame_num > INT_MAX)
+					ereport(ERROR, (errcode(ERRCODE_INVALID_PARAMETER_VALUE),
+									errmsg("unrecognized 'frame' argument"),
+									errhint("Valid values are \"all\", \"outermost\", \"innermost\" and frame number.")));
+				frame = (int) frame_num;
+			}
+
+			node_id = PG_GETARG_INT32(8);
+			if (node_id < -1)
+				ereport(ERROR, (errcode(ERRCODE_INVALID_PARAMETER_VALUE),
+								errmsg("the value of \"node_id\" must be non-negative integer or -1")));
+
+			depth = PG_GETARG_INT32(9);
+			if (depth < -1)
+				ereport(ERROR, (errcode(ERRCODE_INVALID_PARAMETER_VALUE),
+								errmsg("the value of \"depth\" must be non-negative integer or -1")));
+#if PG_VERSION_NUM < 130000
+			if (depth >= 0)
+				ereport(ERROR, (errcode(ERRCODE_FEATURE_NOT_SUPPORTED),
+								errmsg("\"depth\" argument requires PostgreSQL 13 or later")));
+#endif
+		}
+		if (PG_NARGS() > 10)
+			memory = PG_GETARG_BOOL(10);
+		if (PG_NARGS() > 11)
+			progress = PG_GETARG_BOOL(11);
+
 		/*
 		 * init and acquire lock so that any other concurrent calls of this fuction
 		 * can not occupy shared queue for transfering query state
@@ -586,7 +927,13 @@ pg_query_state(PG_FUNCTION_ARGS)
 										   timing,
 										   buffers,
 										   triggers,
-										   format);
+										   format,
+										   frame,
+										   node_id,
+										   depth,
+										   memory,
+										   progress,
+										   false);
 
 		funcctx = SRF_FIRSTCALL_INIT();
 		if (list_length(msgs) == 0)
@@ -649,9 +996,12 @@ pg_query_state(PG_FUNCTION_ARGS)
 						qs_stack = deserialize_stack(current_msg->stack,
 													 current_msg->stack_depth);
 
+						/* no frame is selected in this process */
+						if (qs_stack == NIL)
+							continue;
+
 						p_state->proc = current_msg->proc;
 						p_state->stack = qs_stack;
-						p_state->frame_index = 0;
 						p_state->frame_cursor = list_head(qs_stack);
 
 						fctx->procs = lappend(fctx->procs, p_state);
@@ -699,7 +1049,7 @@ pg_query_state(PG_FUNCTION_ARGS)
 		MemSet(values, 0, sizeof(values));
 		MemSet(nulls, 0, sizeof(nulls));
 		values[0] = Int32GetDatum(p_state->proc->pid);
-		values[1] = Int32GetDatum(p_state->frame_index);
+		values[1] = Int32GetDatum(frame->frame_number);
 		values[2] = PointerGetDatum(frame->query);
 		values[3] = PointerGetDatum(frame->plan);
 		if (p_state->proc->pid == pid)
@@ -714,7 +1064,6 @@ pg_query_state(PG_FUNCTION_ARGS)
 #else
 		p_state->frame_cursor = lnext(p_state->frame_cursor);
 #endif
-		p_state->frame_index++;
 
 		if (p_state->frame_cursor == NULL)
 #if PG_VERSION_NUM >= 130000
@@ -1116,7 +1465,13 @@ GetRemoteBackendQueryStates(PGPROC *leader,
 						    bool timing,
 						    bool buffers,
 						    bool triggers,
-						    ExplainFormat format)
+						    ExplainFormat format,
+						    int frame,
+						    int node_id,
+						    int depth,
+						    bool memory,
+						    bool progress,
+						    bool counters)
 {
 	List			*result = NIL;
 	ListCell		*iter;
@@ -1140,6 +1495,12 @@ GetRemoteBackendQueryStates(PGPROC *leader,
 	params->buffers = buffers;
 	params->triggers = triggers;
 	params->format = format;
+	params->frame = frame;
+	params->node_id = node_id;
+	params->depth = depth;
+	params->memory = memory;
+	params->progress = progress;
+	params->counters = counters;
 	mq = shm_mq_create(mq, QUEUE_SIZE);
 	shm_mq_set_sender(mq, leader);
 	shm_mq_set_receiver(mq, MyProc);
@@ -1261,182 +1622,137 @@ mq_error:
 }
 
 /*
- * Extract the number of actual rows and planned rows from
- * the plan for one node in text format. Returns their ratio,
- * or 1 if there are already more received than planned.
+ * Extract numeric property of plan from the first frame of returned query
+ * state. Progress itself is counted on the side of the target backend (see
+ * PlanProgress) and reported as "Query Progress" and "Rows Processed"
+ * properties of the plan. Returns -1 if property is absent.
  */
 static double
-CountNodeProgress(char *node_text)
+GetNumericProperty(shm_mq_msg *msg, const char *property)
 {
-	char	*rows;				/* Pointer to rows */
-	char	*actual_rows_str;	/* Actual rows in string format */
-	char	*plan_rows_str;		/* Planned rows in string format */
-	int		len;				/* Length of rows in string format */
-	double	actual_rows;		/* Actual rows */
-	double	plan_rows;			/* Planned rows */
-
-	rows = (char *) (strstr(node_text, "\"Actual Rows\": ") /* pointer to "Actual Rows" */
-		   + strlen("\"Actual Rows\": ") * sizeof(char)); /* shift by number of actual rows */
-	len = strstr(rows, "\n") - rows;
-	if (strstr(rows, ",") != NULL && (strstr(rows, ",") - rows) < len)
-		len = strstr(rows, ",") - rows;
-	actual_rows_str = palloc(sizeof(char) * (len + 1));
-	actual_rows_str[len] = 0;
-	strncpy(actual_rows_str, rows, len);
-	actual_rows = strtod(actual_rows_str, NULL);
-	pfree(actual_rows_str);
-
-	rows = strstr(node_text, "\"Plan Rows\": ");
-	rows = (char *) (rows + strlen("\"Plan Rows\": ") * sizeof(char));
-	len = strstr(rows, ",") - rows;
-	plan_rows_str = palloc(sizeof(char) * (len + 1));
-	plan_rows_str[len] = 0;
-	strncpy(plan_rows_str, rows, len);
-	plan_rows = strtod(plan_rows_str, NULL);
-	pfree(plan_rows_str);
-
-	if (plan_rows > actual_rows)
-		return actual_rows / plan_rows;
-	else
-		return 1;
+	List			*qs_stack;
+	stack_frame		*frame;
+	char			*plan_text;
+	char			*key;
+	char			*value;
+
+	qs_stack = deserialize_stack(msg->stack, msg->stack_depth);
+	if (qs_stack == NIL)
+		return -1;
+
+	frame = (stack_frame *) linitial(qs_stack);
+	plan_text = text_to_cstring(frame->plan);
+
+	key = psprintf("\"%s\": ", property);
+	value = strstr(plan_text, key);
+	if (value == NULL)
+		return -1;
+	value += strlen(key);
+
+	return strtod(value, NULL);
 }
 
 /*
- *  Count progress of query execution like ratio of
- *  number of received to planned rows in persent.
- *  Changes of this function can lead to more plausible results.
+ * Progress of query taken by one request to its backend
  */
-static double
-CountProgress(char *plan_text)
+typedef struct
 {
-	char	*plan;				/* Copy of plan_text */
-	char	*node;				/* Part of plan with information about single node */
-	char	*rows;				/* Pointer to rows */
-	double	progress = 0;		/* Summary progress on nodes */
-	int		node_amount = 0;	/* Amount of plantree nodes using in counting progress */
+	PG_QS_RequestResult	 result_code;
+	double				 progress;
+	double				 rows;			/* rows processed by leader and workers */
+	int					 nworkers;
+	int					*worker_pids;
+	double				*worker_rows;
+} progress_capture;
 
-	plan = palloc(sizeof(char) * (strlen(plan_text) + 1));
-	strcpy(plan, plan_text);
-
-	/*
-	 * plan_text contains information about upper node in format:
-	 * 		"Plan": {
-	 * and in different format for other nodes:
-	 * 		"Plans": [
-	 *
-	 * We will iterate over square brackets as over plan nodes.
-	 */
-	node = strtok(plan, "[");	/* Get information about first (but not upper) node */
+/*
+ * Request progress of query running on backend 'proc', optionally with
+ * progress of its parallel workers.
+ *		Lock of requestor side is held only during the request, so other
+ *		requestors may poll backends between periodic captures. Returns false
+ *		if backend doesn't reply.
+ */
+static bool
+capture_progress(PGPROC *proc, bool with_workers, progress_capture *capture)
+{
+	Oid			 counterpart_user_id;
+	List		*workers = NIL;
+	List		*msgs;
+	ListCell	*i;
+	shm_mq_msg	*msg;
+	LOCKTAG		 tag;
 
-	/* Iterating over nodes */
-	while (node != NULL)
-	{
-		/* Result and Modify Table nodes must be skipped */
-		if ((strstr(node, "Result") == NULL) && (strstr(node, "ModifyTable") == NULL))
-		{
-			/* Filter node */
-			if ((rows = strstr(node, "Rows Removed by Filter")) != NULL)
-			{
-				node_amount++;
-				rows = (char *) (rows + strlen("Rows Removed by Filter\": ") * sizeof(char));
-
-				/*
-				* Filter node have 2 conditions:
-				* 1)  Was not filtered (current progress = 0)
-				* 2)  Was filtered (current progress = 1)
-				*/
-				if (rows[0] != '0')
-					progress += 1;
-			}
-			/* Not Filter node */
-			else if (strstr(node, "\"Actual Rows\": ") != NULL)
-			{
-				node_amount++;
-				progress += CountNodeProgress(node);
-			}
-		}
+	LockShmem(&tag, PG_QS_RCV_KEY);
 
-		/* Get next node */
-		node = strtok(NULL, "[");
-	}
+	reqid = *mq_req_id + 1;
 
-	pfree(plan);
-	if (node_amount > 0)
+	counterpart_user_id = GetRemoteBackendUserId(proc);
+	if (!(superuser() || GetUserId() == counterpart_user_id))
 	{
-		progress = progress / node_amount;
-		if (progress == 1)
-			progress = 0.999999;
+		UnlockShmem(&tag);
+		ereport(ERROR, (errcode(ERRCODE_INSUFFICIENT_PRIVILEGE),
+						errmsg("permission denied")));
 	}
-	else
-		return -1;
-	return progress;
-}
 
-static double
-GetCurrentNumericState(shm_mq_msg *msg)
-{
-	typedef struct
-	{
-		PGPROC		*proc;
-		ListCell	*frame_cursor;
-		int			 frame_index;
-		List		*stack;
-	} proc_state;
+	/*
+	 * Progress is counted by the leader, Parallel Seq Scan reports blocks
+	 * scanned by all workers, so workers are polled only for their own rows
+	 */
+	if (with_workers)
+		workers = GetRemoteBackendWorkers(proc);
+	msgs = GetRemoteBackendQueryStates(proc,
+									   workers,
+									   0, 1, 0, 0, 0,
+									   EXPLAIN_FORMAT_JSON,
+									   0, -1, PROGRESS_PLAN_DEPTH,
+									   false, true, false);
+	UnlockShmem(&tag);
 
-	/* multicall context type */
-	typedef struct
+	if (list_length(msgs) == 0)
+		return false;
+
+	msg = (shm_mq_msg *) linitial(msgs);
+	capture->result_code = msg->result_code;
+	capture->progress = -1;
+	capture->rows = 0;
+	capture->nworkers = 0;
+	capture->worker_pids = palloc(sizeof(int) * list_length(msgs));
+	capture->worker_rows = palloc(sizeof(double) * list_length(msgs));
+	if (msg->result_code != QS_RETURNED)
+		return true;
+
+	capture->progress = GetNumericProperty(msg, "Query Progress");
+	capture->rows = Max(GetNumericProperty(msg, "Rows Processed"), 0);
+
+	foreach(i, msgs)
 	{
-		ListCell	*proc_cursor;
-		List		*procs;
-	} pg_qs_fctx;
+		double	rows;
 
-	pg_qs_fctx		*fctx;
-	List			*qs_stack;
-	proc_state		*p_state;
-	stack_frame		*frame;
-	char			*plan_text;
+		/* the first reply is of the leader */
+		if (i == list_head(msgs))
+			continue;
 
-	fctx = (pg_qs_fctx *) palloc(sizeof(pg_qs_fctx));
-	fctx->procs = NIL;
-	p_state = (proc_state *) palloc(sizeof(proc_state));
-	qs_stack = deserialize_stack(msg->stack, msg->stack_depth);
-	p_state->proc = msg->proc;
-	p_state->stack = qs_stack;
-	p_state->frame_index = 0;
-	p_state->frame_cursor = list_head(qs_stack);
-	fctx->procs = lappend(fctx->procs, p_state);
-	fctx->proc_cursor = list_head(fctx->procs);
-	frame = (stack_frame *) lfirst(p_state->frame_cursor);
-	plan_text = frame->plan->vl_dat;
-	return CountProgress(plan_text);
+		msg = (shm_mq_msg *) lfirst(i);
+		if (msg->result_code != QS_RETURNED)
+			continue;
+
+		rows = Max(GetNumericProperty(msg, "Rows Processed"), 0);
+		capture->worker_pids[capture->nworkers] = msg->proc->pid;
+		capture->worker_rows[capture->nworkers] = rows;
+		capture->nworkers++;
+		capture->rows += rows;
+	}
+
+	return true;
 }
 
-PG_FUNCTION_INFO_V1(pg_progress_bar);
-Datum
-pg_progress_bar(PG_FUNCTION_ARGS)
+/*
+ * Find backend by pid to request query progress from
+ */
+static PGPROC *
+get_target_backend(pid_t pid)
 {
-	pid_t			pid = PG_GETARG_INT32(0);
-	int				delay = 0;
-	PGPROC			*proc;
-	Oid				counterpart_user_id;
-	shm_mq_msg		*msg;
-	List			*bg_worker_procs = NIL;
-	List			*msgs;
-	double			progress;
-	double			old_progress;
-	LOCKTAG			tag;
-
-	if (PG_NARGS() == 2)
-	{
-		/*
-		 * This is continuous mode, function 'pg_progress_bar_visual',
-		 * we need to get delay value.
-		 */
-		delay = PG_GETARG_INT32(1);
-		if (delay < 1)
-			ereport(ERROR, (errcode(ERRCODE_INVALID_PARAMETER_VALUE),
-						errmsg("the value of \"delay\" must be positive integer")));
-	}
+	PGPROC	*proc;
 
 	if (!module_initialized)
 		ereport(ERROR, (errcode(ERRCODE_FEATURE_NOT_SUPPORTED),
@@ -1458,49 +1774,85 @@ pg_progress_bar(PG_FUNCTION_ARGS)
 		ereport(ERROR, (errcode(ERRCODE_INVALID_PARAMETER_VALUE),
 						errmsg("backend with pid=%d not found", pid)));
 
-	LockShmem(&tag, PG_QS_RCV_KEY);
+	return proc;
+}
 
-	reqid = *mq_req_id + 1;
+/*
+ * Sleep for 'delay' seconds staying responsive to interrupts
+ */
+static void
+sleep_interruptible(double delay)
+{
+	long	remaining = (long) (delay * 1000000);
 
-	counterpart_user_id = GetRemoteBackendUserId(proc);
-	if (!(superuser() || GetUserId() == counterpart_user_id))
-		ereport(ERROR, (errcode(ERRCODE_INSUFFICIENT_PRIVILEGE),
-						errmsg("permission denied")));
+	while (remaining > 0)
+	{
+		long	step = Min(remaining, 100000);
 
-	old_progress = 0;
-	progress = 0;
+		pg_usleep(step);
+		remaining -= step;
+		CHECK_FOR_INTERRUPTS();
+	}
+}
 
-	bg_worker_procs = GetRemoteBackendWorkers(proc);
-	msgs = GetRemoteBackendQueryStates(proc,
-									   bg_worker_procs,
-									   0, 1, 0, 0, 0,
-									   EXPLAIN_FORMAT_JSON);
-	if (list_length(msgs) == 0)
+PG_FUNCTION_INFO_V1(pg_progress_bar);
+Datum
+pg_progress_bar(PG_FUNCTION_ARGS)
+{
+	pid_t			 pid = PG_GETARG_INT32(0);
+	int				 delay = 0;
+	PGPROC			*proc;
+	MemoryContext	 capture_cxt;
+	MemoryContext	 oldcontext;
+	progress_capture capture;
+	bool			 replied;
+	double			 progress;
+	double			 old_progress;
+
+	if (PG_NARGS() == 2)
+	{
+		/*
+		 * This is continuous mode, function 'pg_progress_bar_visual',
+		 * we need to get delay value.
+		 */
+		delay = PG_GETARG_INT32(1);
+		if (delay < 1)
+			ereport(ERROR, (errcode(ERRCODE_INVALID_PARAMETER_VALUE),
+						errmsg("the value of \"delay\" must be positive integer")));
+	}
+
+	proc = get_target_backend(pid);
+
+	/* replies of each capture are freed before the next one */
+	capture_cxt = AllocSetContextCreate(CurrentMemoryContext,
+										"pg_progress_bar capture",
+										ALLOCSET_DEFAULT_SIZES);
+
+	oldcontext = MemoryContextSwitchTo(capture_cxt);
+	replied = capture_progress(proc, false, &capture);
+	MemoryContextSwitchTo(oldcontext);
+	if (!replied)
 	{
 		elog(WARNING, "backend does not reply");
-		UnlockShmem(&tag);
 		PG_RETURN_FLOAT8((float8) -1);
 	}
-	msg = (shm_mq_msg *) linitial(msgs);
 
-	switch (msg->result_code)
+	switch (capture.result_code)
 	{
 		case QUERY_NOT_RUNNING:
 			elog(INFO, "query not runing");
-			UnlockShmem(&tag);
 			PG_RETURN_FLOAT8((float8) -1);
 			break;
 		case STAT_DISABLED:
 			elog(INFO, "query execution statistics disabled");
-			UnlockShmem(&tag);
 			PG_RETURN_FLOAT8((float8) -1);
 		default:
 			break;
 	}
-	if (msg->result_code == QS_RETURNED && delay == 0)
+
+	progress = capture.progress;
+	if (delay == 0)
 	{
-		UnlockShmem(&tag);
-		progress = GetCurrentNumericState(msg);
 		if (progress < 0)
 		{
 			elog(INFO, "could not get query execution progress");
@@ -1509,46 +1861,444 @@ pg_progress_bar(PG_FUNCTION_ARGS)
 		else
 			PG_RETURN_FLOAT8((float8) progress);
 	}
-	else if (msg->result_code == QS_RETURNED)
+
+	old_progress = 0;
+	while (capture.result_code == QS_RETURNED)
 	{
-		while (msg->result_code == QS_RETURNED)
+		progress = capture.progress;
+		if (progress > old_progress)
 		{
-			progress = GetCurrentNumericState(msg);
-			if (progress > old_progress)
-			{
-				elog(INFO, "\rProgress = %f", progress);
-				old_progress = progress;
-			}
-			else if (progress < 0)
+			elog(INFO, "\rProgress = %f", progress);
+			old_progress = progress;
+		}
+		else if (progress < 0)
+		{
+			elog(INFO, "could not get query execution progress");
+			break;
+		}
+
+		sleep_interruptible(delay);
+
+		/* backend has exited, so has its query */
+		if (BackendPidGetProc(pid) != proc)
+			break;
+
+		MemoryContextReset(capture_cxt);
+		oldcontext = MemoryContextSwitchTo(capture_cxt);
+		replied = capture_progress(proc, false, &capture);
+		MemoryContextSwitchTo(oldcontext);
+		if (!replied)
+		{
+			elog(WARNING, "backend does not reply");
+			PG_RETURN_FLOAT8((float8) -1);
+		}
+	}
+	if (progress > -1)
+		elog(INFO, "\rProgress = 1.000000");
+	PG_RETURN_FLOAT8((float8) 1);
+}
+
+/*
+ * State of pg_query_state_watch between calls
+ */
+typedef struct
+{
+	PGPROC			*proc;
+	double			 delay;
+	MemoryContext	 capture_cxt;	/* replies of the last capture */
+	TimestampTz		 last_capture;	/* 0 before the first capture */
+	double			 last_rows;
+} watch_state;
+
+#define N_WATCH_ATTRS	7
+
+PG_FUNCTION_INFO_V1(pg_query_state_watch);
+Datum
+pg_query_state_watch(PG_FUNCTION_ARGS)
+{
+	FuncCallContext	*funcctx;
+	watch_state		*state;
+	progress_capture capture;
+	MemoryContext	 oldcontext;
+	TimestampTz		 now;
+	Datum			 values[N_WATCH_ATTRS];
+	bool			 nulls[N_WATCH_ATTRS];
+	Datum			*pids;
+	Datum			*rows;
+	HeapTuple		 tuple;
+	int				 i;
+
+	if (SRF_IS_FIRSTCALL())
+	{
+		pid_t		 pid = PG_GETARG_INT32(0);
+		double		 delay = PG_GETARG_FLOAT8(1);
+		TupleDesc	 tupdesc;
+
+		if (!(delay > 0))
+			ereport(ERROR, (errcode(ERRCODE_INVALID_PARAMETER_VALUE),
+							errmsg("the value of \"delay\" must be positive")));
+
+		funcctx = SRF_FIRSTCALL_INIT();
+		oldcontext = MemoryContextSwitchTo(funcctx->multi_call_memory_ctx);
+
+		if (get_call_result_type(fcinfo, NULL, &tupdesc) != TYPEFUNC_COMPOSITE)
+			elog(ERROR, "return type must be a row type");
+		funcctx->tuple_desc = BlessTupleDesc(tupdesc);
+
+		state = (watch_state *) palloc0(sizeof(watch_state));
+		state->proc = get_target_backend(pid);
+		state->delay = delay;
+		state->capture_cxt = AllocSetContextCreate(funcctx->multi_call_memory_ctx,
+												   "pg_query_state_watch capture",
+												   ALLOCSET_DEFAULT_SIZES);
+		funcctx->user_fctx = state;
+
+		MemoryContextSwitchTo(oldcontext);
+	}
+
+	funcctx = SRF_PERCALL_SETUP();
+	state = (watch_state *) funcctx->user_fctx;
+
+	if (state->last_capture != 0)
+	{
+		sleep_interruptible(state->delay);
+
+		/* backend may have exited or its PGPROC may be reused meanwhile */
+		if (BackendPidGetProc(state->proc->pid) != state->proc)
+			SRF_RETURN_DONE(funcctx);
+	}
+
+	MemoryContextReset(state->capture_cxt);
+	oldcontext = MemoryContextSwitchTo(state->capture_cxt);
+	if (!capture_progress(state->proc, true, &capture))
+	{
+		MemoryContextSwitchTo(oldcontext);
+		elog(WARNING, "backend does not reply");
+		SRF_RETURN_DONE(funcctx);
+	}
+	MemoryContextSwitchTo(oldcontext);
+
+	if (capture.result_code != QS_RETURNED)
+	{
+		/* query has finished between captures, the watch is over */
+		if (state->last_capture == 0)
+			elog(INFO, capture.result_code == STAT_DISABLED
+				 ? "query execution statistics disabled"
+				 : "query not runing");
+		SRF_RETURN_DONE(funcctx);
+	}
+
+	now = GetCurrentTimestamp();
+	MemSet(nulls, 0, sizeof(nulls));
+	values[0] = TimestampTzGetDatum(now);
+	if (capture.progress >= 0)
+		values[1] = Float8GetDatum(capture.progress);
+	else
+		nulls[1] = true;
+	values[2] = Float8GetDatum(capture.rows);
+	if (state->last_capture != 0 && now > state->last_capture)
+		values[3] = Float8GetDatum((capture.rows - state->last_rows) * 1000000.0
+								   / (now - state->last_capture));
+	else
+		nulls[3] = true;
+	values[4] = Int32GetDatum(capture.nworkers);
+
+	pids = palloc(sizeof(Datum) * Max(capture.nworkers, 1));
+	rows = palloc(sizeof(Datum) * Max(capture.nworkers, 1));
+	for (i = 0; i < capture.nworkers; i++)
+	{
+		pids[i] = Int32GetDatum(capture.worker_pids[i]);
+		rows[i] = Float8GetDatum(capture.worker_rows[i]);
+	}
+	values[5] = PointerGetDatum(construct_array(pids, capture.nworkers,
+												INT4OID, sizeof(int32),
+												true, 'i'));
+	values[6] = PointerGetDatum(construct_array(rows, capture.nworkers,
+												FLOAT8OID, sizeof(float8),
+												FLOAT8PASSBYVAL, 'd'));
+
+	state->last_capture = now;
+	state->last_rows = capture.rows;
+
+	tuple = heap_form_tuple(funcctx->tuple_desc, values, nulls);
+	SRF_RETURN_NEXT(funcctx, HeapTupleGetDatum(tuple));
+}
+
+/*
+ * Row counters of plan node summed over leader and its parallel workers
+ */
+typedef struct
+{
+	int					 frame_number;
+	pg_qs_node_counters	 counters;
+	char				*relation;		/* name of relation, NULL if unknown */
+	double				 misestimate;	/* ratio of actual rows to planned ones */
+} node_counters;
+
+/*
+ * Add counters of nodes of one frame dumped by PlanCounters to 'nodes'.
+ *		Counters of node that is already in the list are summed.
+ */
+static List *
+add_node_counters(List *nodes, int frame_number, text *plan)
+{
+	char	*data = VARDATA(plan);
+	int		 nrecords = (VARSIZE(plan) - VARHDRSZ) / sizeof(pg_qs_node_counters);
+	int		 n;
+
+	for (n = 0; n < nrecords; n++)
+	{
+		pg_qs_node_counters	 counters;
+		node_counters		*node = NULL;
+		ListCell			*i;
+
+		/* records are not aligned inside message */
+		memcpy(&counters, data + n * sizeof(pg_qs_node_counters),
+			   sizeof(pg_qs_node_counters));
+
+		foreach(i, nodes)
+		{
+			node_counters *other = (node_counters *) lfirst(i);
+
+			if (other->frame_number == frame_number
+				&& other->counters.plan_node_id == counters.plan_node_id)
 			{
-				elog(INFO, "could not get query execution progress");
+				node = other;
 				break;
 			}
+		}
 
-			for (int i = 0; i < delay; i++)
-			{
-				pg_usleep(1000000);
-				CHECK_FOR_INTERRUPTS();
-			}
+		if (node == NULL)
+		{
+			node = (node_counters *) palloc0(sizeof(node_counters));
+			node->frame_number = frame_number;
+			node->counters = counters;
+			nodes = lappend(nodes, node);
+			continue;
+		}
+		node->counters.loops += counters.loops;
+		node->counters.rows += counters.rows;
+		node->counters.removed += counters.removed;
+	}
 
-			bg_worker_procs = GetRemoteBackendWorkers(proc);
-			msgs = GetRemoteBackendQueryStates(proc,
-											bg_worker_procs,
-											0, 1, 0, 0, 0,
-											EXPLAIN_FORMAT_JSON);
-			if (list_length(msgs) == 0)
-			{
-				elog(WARNING, "backend does not reply");
-				UnlockShmem(&tag);
-				PG_RETURN_FLOAT8((float8) -1);
-			}
-			msg = (shm_mq_msg *) linitial(msgs);
+	return nodes;
+}
+
+/*
+ * Frame of leader that has launched parallel workers, -1 if there is none
+ */
+static int
+parallel_frame(List *nodes)
+{
+	ListCell	*i;
+	int			 result = -1;
+
+	foreach(i, nodes)
+	{
+		node_counters *node = (node_counters *) lfirst(i);
+
+		if (node->counters.node_tag == T_Gather
+#if PG_VERSION_NUM >= 100000
+			|| node->counters.node_tag == T_GatherMerge
+#endif
+			)
+			result = Max(result, node->frame_number);
+	}
+
+	return result;
+}
+
+static int
+compare_misestimates(const void *a, const void *b)
+{
+	const node_counters *na = *(node_counters * const *) a;
+	const node_counters *nb = *(node_counters * const *) b;
+
+	if (na->misestimate > nb->misestimate)
+		return -1;
+	if (na->misestimate < nb->misestimate)
+		return 1;
+	if (na->frame_number != nb->frame_number)
+		return na->frame_number - nb->frame_number;
+	return na->counters.plan_node_id - nb->counters.plan_node_id;
+}
+
+#define N_MISESTIMATES_ATTRS	10
+
+/*
+ * Rank nodes of running query by how much their actual rows exceed planned
+ * ones, summed over leader and parallel workers
+ */
+PG_FUNCTION_INFO_V1(pg_query_state_misestimates);
+Datum
+pg_query_state_misestimates(PG_FUNCTION_ARGS)
+{
+	FuncCallContext	*funcctx;
+	node_counters	**ranked;
+	node_counters	*node;
+	Datum			 values[N_MISESTIMATES_ATTRS];
+	bool			 nulls[N_MISESTIMATES_ATTRS];
+	HeapTuple		 tuple;
+
+	if (SRF_IS_FIRSTCALL())
+	{
+		pid_t			 pid = PG_GETARG_INT32(0);
+		double			 factor = PG_GETARG_FLOAT8(1);
+		PGPROC			*proc;
+		Oid				 counterpart_user_id;
+		List			*workers;
+		List			*msgs;
+		List			*nodes = NIL;
+		ListCell		*i;
+		shm_mq_msg		*msg;
+		MemoryContext	 oldcontext;
+		TupleDesc		 tupdesc;
+		LOCKTAG			 tag;
+		int				 worker_frame;
+		int				 nranked = 0;
+
+		if (!(factor > 0))
+			ereport(ERROR, (errcode(ERRCODE_INVALID_PARAMETER_VALUE),
+							errmsg("the value of \"factor\" must be positive")));
+
+		proc = get_target_backend(pid);
+
+		LockShmem(&tag, PG_QS_RCV_KEY);
+
+		reqid = *mq_req_id + 1;
+
+		counterpart_user_id = GetRemoteBackendUserId(proc);
+		if (!(superuser() || GetUserId() == counterpart_user_id))
+		{
+			UnlockShmem(&tag);
+			ereport(ERROR, (errcode(ERRCODE_INSUFFICIENT_PRIVILEGE),
+							errmsg("permission denied")));
 		}
-		if (progress > -1)
-			elog(INFO, "\rProgress = 1.000000");
+
+		workers = GetRemoteBackendWorkers(proc);
+		msgs = GetRemoteBackendQueryStates(proc,
+										   workers,
+										   0, 0, 0, 0, 0,
+										   EXPLAIN_FORMAT_TEXT,
+										   PG_QS_FRAME_ALL, -1, -1,
+										   false, false, true);
 		UnlockShmem(&tag);
-		PG_RETURN_FLOAT8((float8) 1);
+
+		funcctx = SRF_FIRSTCALL_INIT();
+		if (list_length(msgs) == 0)
+		{
+			elog(WARNING, "backend does not reply");
+			SRF_RETURN_DONE(funcctx);
+		}
+
+		msg = (shm_mq_msg *) linitial(msgs);
+		switch (msg->result_code)
+		{
+			case QUERY_NOT_RUNNING:
+				elog(INFO, "backend is not running query");
+				SRF_RETURN_DONE(funcctx);
+			case STAT_DISABLED:
+				elog(INFO, "query execution statistics disabled");
+				SRF_RETURN_DONE(funcctx);
+			default:
+				break;
+		}
+
+		oldcontext = MemoryContextSwitchTo(funcctx->multi_call_memory_ctx);
+
+		if (get_call_result_type(fcinfo, NULL, &tupdesc) != TYPEFUNC_COMPOSITE)
+			elog(ERROR, "return type must be a row type");
+		funcctx->tuple_desc = BlessTupleDesc(tupdesc);
+
+		/* counters of every frame of leader */
+		foreach(i, deserialize_stack(msg->stack, msg->stack_depth))
+		{
+			stack_frame *frame = (stack_frame *) lfirst(i);
+
+			nodes = add_node_counters(nodes, frame->frame_number, frame->plan);
+		}
+
+		/*
+		 * Plan of worker is the parallel part of the frame that has launched
+		 * it, the outermost frame of worker is numbered from 0 though
+		 */
+		worker_frame = parallel_frame(nodes);
+		foreach(i, msgs)
+		{
+			List		*qs_stack;
+			stack_frame	*frame;
+
+			msg = (shm_mq_msg *) lfirst(i);
+			if (i == list_head(msgs)
+				|| worker_frame < 0
+				|| msg->result_code != QS_RETURNED)
+				continue;
+
+			qs_stack = deserialize_stack(msg->stack, msg->stack_depth);
+			if (qs_stack == NIL)
+				continue;
+
+			frame = (stack_frame *) linitial(qs_stack);
+			nodes = add_node_counters(nodes, worker_frame, frame->plan);
+		}
+
+		ranked = (node_counters **) palloc(sizeof(node_counters *) *
+										   Max(list_length(nodes), 1));
+		foreach(i, nodes)
+		{
+			node = (node_counters *) lfirst(i);
+
+			/*
+			 * Running node may still emit rows it has been planned for, so only
+			 * excess of actual rows over planned ones is a misestimate for sure
+			 */
+			node->misestimate = node->counters.rows /
+				Max(node->counters.plan_rows * Max(node->counters.loops, 1), 1);
+			if (node->misestimate < factor)
+				continue;
+
+			/* catalog of other database isn't available to resolve name */
+			if (OidIsValid(node->counters.relid)
+				&& proc->databaseId == MyDatabaseId)
+				node->relation = get_rel_name(node->counters.relid);
+			ranked[nranked++] = node;
+		}
+		qsort(ranked, nranked, sizeof(node_counters *), compare_misestimates);
+
+		funcctx->user_fctx = ranked;
+		funcctx->max_calls = nranked;
+
+		MemoryContextSwitchTo(oldcontext);
 	}
-	UnlockShmem(&tag);
-	PG_RETURN_FLOAT8((float8) -1);
+
+	funcctx = SRF_PERCALL_SETUP();
+	if (funcctx->call_cntr >= funcctx->max_calls)
+		SRF_RETURN_DONE(funcctx);
+
+	ranked = (node_counters **) funcctx->user_fctx;
+	node = ranked[funcctx->call_cntr];
+
+	MemSet(nulls, 0, sizeof(nulls));
+	values[0] = Int32GetDatum(node->frame_number);
+	values[1] = Int32GetDatum(node->counters.plan_node_id);
+	values[2] = CStringGetTextDatum(psprintf("%s%s",
+											 node->counters.parallel_aware ? "Parallel " : "",
+											 NodeTypeName(node->counters.node_tag,
+														  node->counters.aggstrategy)));
+	if (OidIsValid(node->counters.relid))
+		values[3] = ObjectIdGetDatum(node->counters.relid);
+	else
+		nulls[3] = true;
+	if (node->relation)
+		values[4] = CStringGetTextDatum(node->relation);
+	else
+		nulls[4] = true;
+	values[5] = Float8GetDatum(node->counters.plan_rows);
+	values[6] = Float8GetDatum(node->counters.loops);
+	values[7] = Float8GetDatum(node->counters.rows);
+	values[8] = Float8GetDatum(node->counters.removed);
+	values[9] = Float8GetDatum(node->misestimate);
+
+	tuple = heap_form_tuple(funcctx->tuple_desc, values, nulls);
+	SRF_RETURN_NEXT(funcctx, HeapTupleGetDatum(tuple));
 }
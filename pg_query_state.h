@@ -17,6 +17,7 @@
 #else
 #include "commands/explain.h"
 #endif
+#include "datatype/timestamp.h"
 #include "nodes/pg_list.h"
 #include "storage/procarray.h"
 #include "storage/shm_mq.h"
@@ -26,6 +27,12 @@
 #define WRITING_DELAY		(100 * 1000) /* 100ms */
 #define NUM_OF_ATTEMPTS		6
 
+#define PG_QS_LOG_ON_CANCEL_OFF	(-1)
+
+/* Special values of frame selector, others are frame numbers */
+#define PG_QS_FRAME_ALL			(-1)
+#define PG_QS_FRAME_INNERMOST	(-2)
+
 #define TIMINIG_OFF_WARNING 1
 #define BUFFERS_OFF_WARNING 2
 
@@ -98,12 +105,69 @@ typedef struct
 	bool	buffers;
 	bool	triggers;
 	ExplainFormat format;
+	int		frame;		/* frame number or PG_QS_FRAME_* */
+	int		node_id;	/* plan_node_id of subtree root, -1 for whole plan */
+	int		depth;		/* depth limit of printed plan tree, -1 for none */
+	bool	memory;
+	bool	progress;
+	bool	counters;	/* raw row counters of nodes instead of plan */
 } pg_qs_params;
 
+/*
+ * Raw row counters of plan node sent instead of plan when they are requested.
+ *		Frame consists of array of such records, one for every instrumented
+ *		node. Names are resolved by requestor.
+ */
+typedef struct
+{
+	int		plan_node_id;
+	NodeTag	node_tag;
+	int		aggstrategy;	/* strategy of Agg node, 0 for others */
+	bool	parallel_aware;
+	Oid		relid;			/* InvalidOid if node doesn't scan relation */
+	double	plan_rows;		/* planned rows per loop */
+	double	loops;			/* number of loops including the current one */
+	double	rows;			/* rows emitted by all loops */
+	double	removed;		/* rows removed by filters */
+} pg_qs_node_counters;
+
+/* Number of the topmost plan nodes whose rows are published in progress slot */
+#define PG_QS_PROGRESS_NODES	8
+
+typedef struct
+{
+	int		plan_node_id;
+	double	rows;
+} pg_qs_progress_node;
+
+/*
+ * Summary of query progress published by backend into its shared memory slot.
+ *		Writer increments changecount before and after update, readers retry
+ *		copying until they see the same even value on both sides.
+ */
+typedef struct
+{
+	uint32		changecount;
+	int			pid;			/* 0 if backend doesn't publish its progress */
+	Oid			userid;
+	Oid			dbid;
+	int64		query_id;
+	TimestampTz	query_start;
+	TimestampTz	updated;
+	double		progress;		/* -1 if unknown */
+	int			nworkers;
+	int			nnodes;
+	pg_qs_progress_node nodes[PG_QS_PROGRESS_NODES];
+} pg_qs_progress_slot;
+
 /* pg_query_state */
 extern bool pg_qs_enable;
 extern bool pg_qs_timing;
 extern bool pg_qs_buffers;
+extern int pg_qs_log_on_cancel;
+extern int pg_qs_log_on_cancel_max_size;
+extern int pg_qs_timing_sample_rate;
+extern int pg_qs_progress_update_interval;
 extern List *QueryDescStack;
 extern pg_qs_params * params;
 extern shm_mq *mq;
@@ -113,11 +177,32 @@ extern ProcSignalReason UserIdPollReason;
 extern ProcSignalReason QueryStatePollReason;
 extern ProcSignalReason WorkerPollReason;
 
+extern bool IsTimingSampled(PlanState *planstate);
+
 /* signal_handler.c */
 extern void SendQueryState(void);
 extern void SendCurrentUserId(void);
 extern void UnlockShmem(LOCKTAG *tag);
 extern void LockShmem(LOCKTAG *tag, uint32 key);
 extern msg_by_parts_result send_msg_by_parts(shm_mq_handle *mqh, Size nbytes, const void *data);
+extern void LogQueryState(List *query_desc_stack, ExplainFormat format,
+						  int max_size, const char *reason);
+
+/* plan_stats.c */
+extern void PrintMemoryUsage(ExplainState *es, QueryDesc *queryDesc,
+							 PlanState *planstate);
+extern double PlanProgress(PlanState *planstate);
+extern void PrintProgress(ExplainState *es, PlanState *planstate);
+extern char *PlanCounters(QueryDesc *queryDesc, PlanState *planstate, int *len);
+extern const char *NodeTypeName(NodeTag node_tag, int aggstrategy);
+
+/* progress_slot.c */
+extern pg_qs_progress_slot *progress_slots;
+extern int ProgressSlotsCount(void);
+extern Size ProgressSlotsShmemSize(void);
+extern void StartProgressReport(QueryDesc *queryDesc);
+extern void StopProgressReport(void);
+extern volatile sig_atomic_t ProgressUpdatePending;
+extern void UpdateProgressSlot(void);
 
 #endif
@@ -0,0 +1,823 @@
+/*
+ * plan_stats.c
+ *		Collect statistics of running plan nodes that EXPLAIN doesn't show
+ *		until the query is finished
+ *
+ * Copyright (c) 2016-2025, Postgres Professional
+ *
+ * IDENTIFICATION
+ *	  contrib/pg_query_state/plan_stats.c
+ */
+
+#include "pg_query_state.h"
+
+#include "access/heapam.h"
+#include "access/relscan.h"
+#if PG_VERSION_NUM >= 120000
+#include "access/tableam.h"
+#endif
+#if PG_VERSION_NUM >= 180000
+#include "commands/explain_format.h"
+#endif
+#include "executor/hashjoin.h"
+#if PG_VERSION_NUM >= 130000
+#include "executor/nodeAgg.h"
+#endif
+#include "nodes/nodeFuncs.h"
+#include "parser/parsetree.h"
+#include "utils/memutils.h"
+#include "utils/tuplesort.h"
+#include "utils/tuplestore.h"
+
+#define BYTES_TO_KB(bytes) (((bytes) + 1023) / 1024)
+
+static void
+property_int(const char *qlabel, int64 value, const char *unit, ExplainState *es)
+{
+#if PG_VERSION_NUM >= 110000
+	ExplainPropertyInteger(qlabel, unit, value, es);
+#else
+	ExplainPropertyLong(qlabel, (long) value, es);
+#endif
+}
+
+/*
+ * Start properties of plan node, in text format they go on separate lines
+ * under header with node name
+ */
+static void
+open_node_group(PlanState *planstate, const char *name, ExplainState *es)
+{
+	if (es->format == EXPLAIN_FORMAT_TEXT)
+	{
+		appendStringInfoSpaces(es->str, es->indent * 2);
+		appendStringInfo(es->str, "%s (node %d):\n",
+						 name, planstate->plan->plan_node_id);
+		es->indent++;
+	}
+	else
+	{
+		ExplainOpenGroup("Node", NULL, true, es);
+		ExplainPropertyText("Node Type", name, es);
+		property_int("Plan Node Id", planstate->plan->plan_node_id, NULL, es);
+	}
+}
+
+static void
+close_node_group(ExplainState *es)
+{
+	if (es->format == EXPLAIN_FORMAT_TEXT)
+		es->indent--;
+	else
+		ExplainCloseGroup("Node", NULL, true, es);
+}
+
+/*
+ * Print where rows of tuplestore are kept now
+ */
+static void
+print_tuplestore_memory(PlanState *planstate, const char *name,
+						Tuplestorestate *tuplestore, ExplainState *es)
+{
+#if PG_VERSION_NUM >= 180000
+	char	   *max_storage_type;
+	int64		max_space;
+#endif
+
+	if (tuplestore == NULL)
+		return;
+
+	open_node_group(planstate, name, es);
+	ExplainPropertyText("Storage",
+						tuplestore_in_memory(tuplestore) ? "Memory" : "Disk",
+						es);
+#if PG_VERSION_NUM >= 180000
+	tuplestore_get_stats(tuplestore, &max_storage_type, &max_space);
+	property_int("Maximum Storage", BYTES_TO_KB(max_space), "kB", es);
+#endif
+	close_node_group(es);
+}
+
+/*
+ * Print memory of hash table being built or probed by Hash node
+ */
+static void
+print_hash_memory(HashState *hashstate, ExplainState *es)
+{
+	HashJoinTable hashtable = hashstate->hashtable;
+
+	if (hashtable == NULL)
+		return;
+
+	open_node_group(&hashstate->ps, "Hash", es);
+	property_int("Memory Usage", BYTES_TO_KB(hashtable->spaceUsed), "kB", es);
+	property_int("Peak Memory Usage", BYTES_TO_KB(hashtable->spacePeak), "kB", es);
+	property_int("Hash Buckets", hashtable->nbuckets, NULL, es);
+	property_int("Hash Batches", hashtable->nbatch, NULL, es);
+	property_int("Original Hash Batches", hashtable->nbatch_original, NULL, es);
+	close_node_group(es);
+}
+
+/*
+ * Print state of sort, whether it fits in memory or is spilled to disk
+ */
+static void
+print_sort_memory(SortState *sortstate, ExplainState *es)
+{
+	Tuplesortstate *tuplesort = (Tuplesortstate *) sortstate->tuplesortstate;
+#if PG_VERSION_NUM >= 110000
+	TuplesortInstrumentation stats;
+#else
+	const char *sort_method;
+	const char *space_type;
+	long		space_used;
+#endif
+
+	if (tuplesort == NULL)
+		return;
+
+	open_node_group(&sortstate->ss.ps, "Sort", es);
+#if PG_VERSION_NUM >= 110000
+	tuplesort_get_stats(tuplesort, &stats);
+	ExplainPropertyText("Sort Method", tuplesort_method_name(stats.sortMethod), es);
+	property_int("Sort Space Used", stats.spaceUsed, "kB", es);
+	ExplainPropertyText("Sort Space Type", tuplesort_space_type_name(stats.spaceType), es);
+#else
+	tuplesort_get_stats(tuplesort, &sort_method, &space_type, &space_used);
+	ExplainPropertyText("Sort Method", sort_method, es);
+	property_int("Sort Space Used", space_used, "kB", es);
+	ExplainPropertyText("Sort Space Type", space_type, es);
+#endif
+	close_node_group(es);
+}
+
+#if PG_VERSION_NUM >= 130000
+/*
+ * Print memory of hash table of aggregate and its spill to disk
+ */
+static void
+print_agg_memory(AggState *aggstate, ExplainState *es)
+{
+	MemoryContext	hashkeycxt;
+	Size			mem_used;
+	int				i;
+
+	if (aggstate->hash_metacxt == NULL || aggstate->hashcontext == NULL)
+		return;
+
+	/*
+	 * Sum up contexts like hash_agg_update_metrics() does. Depending on
+	 * version hash entries are kept either in context of transition states
+	 * or in separate one shared by all hash tables.
+	 */
+	hashkeycxt = aggstate->hashcontext->ecxt_per_tuple_memory;
+	mem_used = MemoryContextMemAllocated(aggstate->hash_metacxt, true)
+		+ MemoryContextMemAllocated(hashkeycxt, true);
+	for (i = 0; i < aggstate->num_hashes; i++)
+	{
+		TupleHashTable	hashtable = aggstate->perhash[i].hashtable;
+		int				j;
+
+		if (hashtable == NULL || hashtable->tablecxt == hashkeycxt
+			|| hashtable->tablecxt == aggstate->hash_metacxt)
+			continue;
+		for (j = 0; j < i; j++)
+			if (aggstate->perhash[j].hashtable
+				&& aggstate->perhash[j].hashtable->tablecxt == hashtable->tablecxt)
+				break;
+		if (j == i)
+			mem_used += MemoryContextMemAllocated(hashtable->tablecxt, true);
+	}
+
+	open_node_group(&aggstate->ss.ps,
+					aggstate->aggstrategy == AGG_MIXED ? "MixedAggregate" : "HashAggregate",
+					es);
+	property_int("Memory Usage", BYTES_TO_KB(mem_used), "kB", es);
+	property_int("Peak Memory Usage", BYTES_TO_KB(aggstate->hash_mem_peak), "kB", es);
+	property_int("HashAgg Batches", aggstate->hash_batches_used, NULL, es);
+	property_int("Disk Usage", aggstate->hash_disk_used, "kB", es);
+	close_node_group(es);
+}
+#endif
+
+/*
+ * Print memory held by each node of plan subtree whose root is planstate
+ */
+static bool
+print_node_memory(PlanState *planstate, ExplainState *es)
+{
+	if (planstate == NULL)
+		return false;
+
+	switch (nodeTag(planstate))
+	{
+		case T_HashState:
+			print_hash_memory((HashState *) planstate, es);
+			break;
+		case T_SortState:
+			print_sort_memory((SortState *) planstate, es);
+			break;
+#if PG_VERSION_NUM >= 130000
+		case T_AggState:
+			print_agg_memory((AggState *) planstate, es);
+			break;
+#endif
+		case T_MaterialState:
+			print_tuplestore_memory(planstate, "Materialize",
+									((MaterialState *) planstate)->tuplestorestate,
+									es);
+			break;
+		case T_CteScanState:
+			{
+				CteScanState *ctestate = (CteScanState *) planstate;
+
+				/* tuplestore is shared by all scans of CTE, show it once */
+				if (ctestate->leader == ctestate)
+					print_tuplestore_memory(planstate, "CTE Scan",
+											ctestate->cte_table, es);
+			}
+			break;
+		case T_WindowAggState:
+			print_tuplestore_memory(planstate, "WindowAgg",
+									((WindowAggState *) planstate)->buffer,
+									es);
+			break;
+#if PG_VERSION_NUM >= 140000
+		case T_MemoizeState:
+			{
+				MemoizeState *mstate = (MemoizeState *) planstate;
+
+				if (mstate->hashtable == NULL)
+					break;
+				open_node_group(planstate, "Memoize", es);
+				property_int("Memory Usage", BYTES_TO_KB(mstate->mem_used), "kB", es);
+				close_node_group(es);
+			}
+			break;
+#endif
+		default:
+			break;
+	}
+
+	return planstate_tree_walker(planstate, print_node_memory, (void *) es);
+}
+
+/*
+ * Print memory currently used by query: size of executor memory context
+ * of the whole frame and memory held by hashes, sorts and tuplestores of
+ * nodes under planstate.
+ */
+void
+PrintMemoryUsage(ExplainState *es, QueryDesc *queryDesc, PlanState *planstate)
+{
+	if (es->format == EXPLAIN_FORMAT_TEXT)
+	{
+		appendStringInfoSpaces(es->str, es->indent * 2);
+		appendStringInfoString(es->str, "Memory:\n");
+		es->indent++;
+	}
+	ExplainOpenGroup("Memory", "Memory", true, es);
+
+#if PG_VERSION_NUM >= 130000
+	if (queryDesc->estate)
+		property_int("Executor Memory",
+					 BYTES_TO_KB(MemoryContextMemAllocated(queryDesc->estate->es_query_cxt, true)),
+					 "kB", es);
+#endif
+
+	ExplainOpenGroup("Nodes", "Nodes", false, es);
+	print_node_memory(planstate, es);
+	ExplainCloseGroup("Nodes", "Nodes", false, es);
+
+	ExplainCloseGroup("Memory", "Memory", true, es);
+	if (es->format == EXPLAIN_FORMAT_TEXT)
+		es->indent--;
+}
+
+/*
+ * Get number of heap blocks already scanned by Seq Scan node and number of
+ * blocks of relation to scan. Parallel scan reports blocks allocated to all
+ * participants from its shared descriptor. Returns false if the node doesn't
+ * scan heap blocks or hasn't started yet.
+ */
+static bool
+scan_blocks(SeqScanState *node, BlockNumber *scanned, BlockNumber *nblocks)
+{
+#if PG_VERSION_NUM >= 120000
+	TableScanDesc scan = node->ss.ss_currentScanDesc;
+	HeapScanDesc heapscan = (HeapScanDesc) scan;
+	ParallelBlockTableScanDesc pscan;
+#else
+	HeapScanDesc heapscan = node->ss.ss_currentScanDesc;
+	ParallelHeapScanDesc pscan;
+#endif
+	Instrumentation *instr = node->ss.ps.instrument;
+	uint64		nallocated;
+
+	/* scan is not started yet, size of relation is unknown */
+	if (heapscan == NULL)
+		return false;
+
+#if PG_VERSION_NUM >= 120000
+	if (scan->rs_rd->rd_tableam != GetHeapamTableAmRoutine())
+		return false;
+	pscan = (ParallelBlockTableScanDesc) scan->rs_parallel;
+#else
+	pscan = heapscan->rs_parallel;
+#endif
+
+	if (pscan != NULL)
+	{
+		*nblocks = pscan->phs_nblocks;
+#if PG_VERSION_NUM >= 110000
+		nallocated = pg_atomic_read_u64(&pscan->phs_nallocated);
+#else
+		/* phs_cblock is next block to allocate, invalid after the last one */
+		if (pscan->phs_cblock == InvalidBlockNumber)
+			nallocated = pscan->phs_nblocks;
+		else
+			nallocated = (pscan->phs_cblock + pscan->phs_nblocks
+						  - pscan->phs_startblock) % Max(pscan->phs_nblocks, 1);
+#endif
+		*scanned = (BlockNumber) Min(nallocated, (uint64) *nblocks);
+	}
+	else
+	{
+		*nblocks = heapscan->rs_nblocks;
+		if (heapscan->rs_inited && heapscan->rs_cblock != InvalidBlockNumber)
+			*scanned = (heapscan->rs_cblock + heapscan->rs_nblocks
+						- heapscan->rs_startblock) % heapscan->rs_nblocks + 1;
+		else if (instr && instr->running)
+			/* heap scan resets its position after the last block */
+			*scanned = heapscan->rs_nblocks;
+		else
+			*scanned = 0;
+	}
+
+	return *nblocks > 0;
+}
+
+/*
+ * Print heap blocks scanned by Seq Scan nodes
+ */
+static bool
+print_scan_blocks(PlanState *planstate, ExplainState *es)
+{
+	BlockNumber	scanned,
+				nblocks;
+
+	if (planstate == NULL)
+		return false;
+
+	if (IsA(planstate, SeqScanState)
+		&& scan_blocks((SeqScanState *) planstate, &scanned, &nblocks))
+	{
+		open_node_group(planstate,
+						planstate->plan->parallel_aware ? "Parallel Seq Scan" : "Seq Scan",
+						es);
+		property_int("Heap Blocks Scanned", scanned, NULL, es);
+		property_int("Heap Blocks", nblocks, NULL, es);
+		close_node_group(es);
+	}
+
+	return planstate_tree_walker(planstate, print_scan_blocks, (void *) es);
+}
+
+/*
+ * Fraction of planned rows the node has emitted in its current loop
+ */
+static double
+rows_ratio(PlanState *planstate)
+{
+	Instrumentation *instr = planstate->instrument;
+	double		plan_rows = planstate->plan->plan_rows;
+
+	if (instr == NULL)
+		return 0;
+	if (plan_rows <= instr->tuplecount)
+		return 1;
+	return instr->tuplecount / plan_rows;
+}
+
+/*
+ * Progress of single node from 0 to 1, or -1 if node isn't counted.
+ *		Nodes that consume their whole input before returning first row
+ *		spend the first half of their progress on input and the second one
+ *		on output, otherwise a query stuck in sort or hash build would show
+ *		no progress until it is over.
+ */
+static double
+node_progress(PlanState *planstate)
+{
+	Instrumentation *instr = planstate->instrument;
+	PlanState  *outer = outerPlanState(planstate);
+
+	if (instr == NULL)
+		return -1;
+
+	/* all loops of node are done, no current one is started */
+	if (instr->nloops > 0 && !instr->running)
+		return 1;
+
+	switch (nodeTag(planstate))
+	{
+		case T_SeqScanState:
+			{
+				BlockNumber	scanned,
+							nblocks;
+
+				/* rows are poor measure for selective filter, prefer blocks */
+				if (scan_blocks((SeqScanState *) planstate, &scanned, &nblocks))
+					return (double) scanned / nblocks;
+				return rows_ratio(planstate);
+			}
+
+		case T_SortState:
+			if (((SortState *) planstate)->sort_Done)
+				return 0.5 + 0.5 * rows_ratio(planstate);
+			return outer ? 0.5 * rows_ratio(outer) : 0;
+
+		case T_AggState:
+			{
+				AggState   *aggstate = (AggState *) planstate;
+				bool		input_done;
+
+				if (aggstate->aggstrategy == AGG_PLAIN)
+					input_done = aggstate->agg_done || instr->tuplecount > 0;
+#if PG_VERSION_NUM >= 100000
+				else if (aggstate->aggstrategy == AGG_HASHED
+						 || aggstate->aggstrategy == AGG_MIXED)
+#else
+				else if (aggstate->aggstrategy == AGG_HASHED)
+#endif
+					input_done = aggstate->table_filled;
+				else
+					return rows_ratio(planstate);
+
+				if (input_done)
+					return 0.5 + 0.5 * rows_ratio(planstate);
+				return outer ? 0.5 * rows_ratio(outer) : 0;
+			}
+
+		case T_HashState:
+			{
+				HashJoinTable hashtable = ((HashState *) planstate)->hashtable;
+				double		plan_rows = planstate->plan->plan_rows;
+
+				/* Hash returns no rows, the whole work is to consume input */
+				if (hashtable == NULL)
+					return 0;
+				if (plan_rows <= hashtable->totalTuples)
+					return 1;
+				return hashtable->totalTuples / plan_rows;
+			}
+
+		case T_HashJoinState:
+			{
+				HashJoinTable hashtable = ((HashJoinState *) planstate)->hj_HashTable;
+				double		progress = rows_ratio(planstate);
+
+				/* batches are joined one by one after the first pass */
+				if (hashtable && hashtable->nbatch > 1)
+					progress = Max(progress,
+								   (double) hashtable->curbatch / hashtable->nbatch);
+				return progress;
+			}
+
+		default:
+			return rows_ratio(planstate);
+	}
+}
+
+typedef struct
+{
+	double	progress;
+	int		node_amount;
+} progress_context;
+
+static bool
+sum_node_progress(PlanState *planstate, progress_context *context)
+{
+	double	progress;
+
+	if (planstate == NULL)
+		return false;
+
+	/* Result and ModifyTable nodes don't tell anything about progress */
+	if (!IsA(planstate, ResultState) && !IsA(planstate, ModifyTableState))
+	{
+		progress = node_progress(planstate);
+		if (progress >= 0)
+		{
+			context->progress += progress;
+			context->node_amount++;
+		}
+	}
+
+	return planstate_tree_walker(planstate, sum_node_progress, (void *) context);
+}
+
+/*
+ * Estimate progress of plan subtree as average progress of its nodes.
+ *		Returns value from 0 to 1 that never reaches 1 while query is running,
+ *		or -1 if there are no nodes to count progress on.
+ */
+double
+PlanProgress(PlanState *planstate)
+{
+	progress_context context;
+
+	context.progress = 0;
+	context.node_amount = 0;
+	sum_node_progress(planstate, &context);
+
+	if (context.node_amount == 0)
+		return -1;
+	return Min(context.progress / context.node_amount, 0.999999);
+}
+
+static bool
+sum_node_rows(PlanState *planstate, double *rows)
+{
+	Instrumentation *instr;
+
+	if (planstate == NULL)
+		return false;
+
+	/*
+	 * Rows of Gather are mostly produced by workers, which count them in their
+	 * own plans, rows of the leader are counted by nodes below Gather
+	 */
+	instr = planstate->instrument;
+	if (instr && !IsA(planstate, GatherState)
+#if PG_VERSION_NUM >= 100000
+		&& !IsA(planstate, GatherMergeState)
+#endif
+		)
+		*rows += instr->ntuples + instr->tuplecount;
+
+	return planstate_tree_walker(planstate, sum_node_rows, (void *) rows);
+}
+
+/*
+ * Count rows emitted by all nodes of plan subtree so far except Gather, the
+ * measure of work done by backend that grows even when progress can't be
+ * estimated
+ */
+static double
+plan_rows(PlanState *planstate)
+{
+	double	rows = 0;
+
+	sum_node_rows(planstate, &rows);
+	return rows;
+}
+
+/*
+ * Print estimated progress of plan subtree, rows processed by it and heap
+ * blocks scanned by its Seq Scan nodes
+ */
+void
+PrintProgress(ExplainState *es, PlanState *planstate)
+{
+#if PG_VERSION_NUM >= 110000
+	ExplainPropertyFloat("Query Progress", NULL, PlanProgress(planstate), 6, es);
+#else
+	ExplainPropertyFloat("Query Progress", PlanProgress(planstate), 6, es);
+#endif
+#if PG_VERSION_NUM >= 110000
+	ExplainPropertyFloat("Rows Processed", NULL, plan_rows(planstate), 0, es);
+#else
+	ExplainPropertyFloat("Rows Processed", plan_rows(planstate), 0, es);
+#endif
+
+	if (es->format == EXPLAIN_FORMAT_TEXT)
+	{
+		appendStringInfoSpaces(es->str, es->indent * 2);
+		appendStringInfoString(es->str, "Scans:\n");
+		es->indent++;
+	}
+	ExplainOpenGroup("Scans", "Scans", false, es);
+	print_scan_blocks(planstate, es);
+	ExplainCloseGroup("Scans", "Scans", false, es);
+	if (es->format == EXPLAIN_FORMAT_TEXT)
+		es->indent--;
+}
+
+/*
+ * Name of plan node as EXPLAIN prints it, without join type and strategy
+ * details that don't matter for finding of misestimated nodes
+ */
+const char *
+NodeTypeName(NodeTag node_tag, int aggstrategy)
+{
+	switch (node_tag)
+	{
+		case T_Result:
+			return "Result";
+#if PG_VERSION_NUM >= 100000
+		case T_ProjectSet:
+			return "ProjectSet";
+#endif
+		case T_ModifyTable:
+			return "ModifyTable";
+		case T_Append:
+			return "Append";
+		case T_MergeAppend:
+			return "Merge Append";
+		case T_RecursiveUnion:
+			return "Recursive Union";
+		case T_BitmapAnd:
+			return "BitmapAnd";
+		case T_BitmapOr:
+			return "BitmapOr";
+		case T_NestLoop:
+			return "Nested Loop";
+		case T_MergeJoin:
+			return "Merge Join";
+		case T_HashJoin:
+			return "Hash Join";
+		case T_SeqScan:
+			return "Seq Scan";
+		case T_SampleScan:
+			return "Sample Scan";
+		case T_Gather:
+			return "Gather";
+#if PG_VERSION_NUM >= 100000
+		case T_GatherMerge:
+			return "Gather Merge";
+#endif
+		case T_IndexScan:
+			return "Index Scan";
+		case T_IndexOnlyScan:
+			return "Index Only Scan";
+		case T_BitmapIndexScan:
+			return "Bitmap Index Scan";
+		case T_BitmapHeapScan:
+			return "Bitmap Heap Scan";
+		case T_TidScan:
+			return "Tid Scan";
+#if PG_VERSION_NUM >= 140000
+		case T_TidRangeScan:
+			return "Tid Range Scan";
+#endif
+		case T_SubqueryScan:
+			return "Subquery Scan";
+		case T_FunctionScan:
+			return "Function Scan";
+#if PG_VERSION_NUM >= 100000
+		case T_TableFuncScan:
+			return "Table Function Scan";
+		case T_NamedTuplestoreScan:
+			return "Named Tuplestore Scan";
+#endif
+		case T_ValuesScan:
+			return "Values Scan";
+		case T_CteScan:
+			return "CTE Scan";
+		case T_WorkTableScan:
+			return "WorkTable Scan";
+		case T_ForeignScan:
+			return "Foreign Scan";
+		case T_CustomScan:
+			return "Custom Scan";
+		case T_Material:
+			return "Materialize";
+#if PG_VERSION_NUM >= 140000
+		case T_Memoize:
+			return "Memoize";
+#endif
+		case T_Sort:
+			return "Sort";
+#if PG_VERSION_NUM >= 130000
+		case T_IncrementalSort:
+			return "Incremental Sort";
+#endif
+		case T_Group:
+			return "Group";
+		case T_Agg:
+			switch ((AggStrategy) aggstrategy)
+			{
+				case AGG_SORTED:
+					return "GroupAggregate";
+				case AGG_HASHED:
+					return "HashAggregate";
+#if PG_VERSION_NUM >= 110000
+				case AGG_MIXED:
+					return "MixedAggregate";
+#endif
+				default:
+					return "Aggregate";
+			}
+		case T_WindowAgg:
+			return "WindowAgg";
+		case T_Unique:
+			return "Unique";
+		case T_SetOp:
+			return "SetOp";
+		case T_LockRows:
+			return "LockRows";
+		case T_Limit:
+			return "Limit";
+		case T_Hash:
+			return "Hash";
+		default:
+			return "???";
+	}
+}
+
+/*
+ * Relation scanned by plan node, InvalidOid if node doesn't scan relation
+ */
+static Oid
+node_relid(Plan *plan, List *rtable)
+{
+	Index			 scanrelid;
+	RangeTblEntry	*rte;
+
+	switch (nodeTag(plan))
+	{
+		case T_SeqScan:
+		case T_SampleScan:
+		case T_IndexScan:
+		case T_IndexOnlyScan:
+		case T_BitmapHeapScan:
+		case T_TidScan:
+#if PG_VERSION_NUM >= 140000
+		case T_TidRangeScan:
+#endif
+		case T_ForeignScan:
+		case T_CustomScan:
+			scanrelid = ((Scan *) plan)->scanrelid;
+			break;
+		default:
+			return InvalidOid;
+	}
+
+	/* foreign and custom scans of joins have no relation of their own */
+	if (scanrelid == 0)
+		return InvalidOid;
+
+	rte = rt_fetch(scanrelid, rtable);
+	if (rte->rtekind != RTE_RELATION)
+		return InvalidOid;
+	return rte->relid;
+}
+
+typedef struct
+{
+	StringInfo	 buf;
+	List		*rtable;
+} counters_context;
+
+static bool
+dump_node_counters(PlanState *planstate, counters_context *context)
+{
+	Instrumentation		*instr;
+	Plan				*plan;
+	pg_qs_node_counters	 counters;
+
+	if (planstate == NULL)
+		return false;
+
+	instr = planstate->instrument;
+	plan = planstate->plan;
+	if (instr)
+	{
+		MemSet(&counters, 0, sizeof(counters));
+		counters.plan_node_id = plan->plan_node_id;
+		counters.node_tag = nodeTag(plan);
+		if (IsA(plan, Agg))
+			counters.aggstrategy = (int) ((Agg *) plan)->aggstrategy;
+		counters.parallel_aware = plan->parallel_aware;
+		counters.relid = node_relid(plan, context->rtable);
+		counters.plan_rows = plan->plan_rows;
+		counters.loops = instr->nloops + (instr->running ? 1 : 0);
+		counters.rows = instr->ntuples + instr->tuplecount;
+		counters.removed = instr->nfiltered1 + instr->nfiltered2;
+		appendBinaryStringInfo(context->buf, (char *) &counters,
+							   sizeof(counters));
+	}
+
+	return planstate_tree_walker(planstate, dump_node_counters, (void *) context);
+}
+
+/*
+ * Dump raw row counters of every instrumented node of plan subtree as array
+ * of pg_qs_node_counters, so that requestor could compare them with estimates
+ * without printing and parsing of EXPLAIN. Size of array is returned in *len.
+ */
+char *
+PlanCounters(QueryDesc *queryDesc, PlanState *planstate, int *len)
+{
+	StringInfoData		buf;
+	counters_context	context;
+
+	initStringInfo(&buf);
+	context.buf = &buf;
+	context.rtable = queryDesc->plannedstmt->rtable;
+	dump_node_counters(planstate, &context);
+
+	*len = buf.len;
+	return buf.data;
+}
@@ -0,0 +1,415 @@
+/*
+ * progress_slot.c
+ *		Publish summary of query progress into shared memory slot of backend,
+ *		so that it can be read without signalling the backend
+ *
+ * Copyright (c) 2016-2025, Postgres Professional
+ *
+ * IDENTIFICATION
+ *	  contrib/pg_query_state/progress_slot.c
+ */
+
+#include "pg_query_state.h"
+
+#include "access/parallel.h"
+#include "access/xact.h"
+#include "catalog/pg_type.h"
+#include "executor/execParallel.h"
+#include "funcapi.h"
+#include "miscadmin.h"
+#include "nodes/nodeFuncs.h"
+#include "port/atomics.h"
+#include "postmaster/autovacuum.h"
+#if PG_VERSION_NUM >= 120000
+#include "replication/walsender.h"
+#endif
+#include "storage/ipc.h"
+#include "storage/proc.h"
+#include "utils/acl.h"
+#include "utils/array.h"
+#include "utils/timeout.h"
+#include "utils/timestamp.h"
+
+pg_qs_progress_slot *progress_slots = NULL;
+
+/* Slot of current backend and query being published to it */
+static pg_qs_progress_slot *my_slot = NULL;
+static QueryDesc *published_query = NULL;
+static TimestampTz published_query_start;
+static TimeoutId progress_timeout;
+static bool progress_timeout_registered = false;
+
+/* Set by timer, the slot is refreshed on the next call of a plan node */
+volatile sig_atomic_t ProgressUpdatePending = false;
+
+typedef struct
+{
+	int			nnodes;
+	int			nworkers;
+	pg_qs_progress_node nodes[PG_QS_PROGRESS_NODES];
+} progress_summary;
+
+/*
+ * Number of slots, one for every backend that may run a query
+ *		MaxBackends isn't computed yet when shared memory is requested on
+ *		PostgreSQL older than 15, so count it the same way as core does.
+ */
+int
+ProgressSlotsCount(void)
+{
+#if PG_VERSION_NUM >= 150000
+	return MaxBackends;
+#elif PG_VERSION_NUM >= 120000
+	return MaxConnections + autovacuum_max_workers + 1 +
+		max_worker_processes + max_wal_senders;
+#else
+	return MaxConnections + autovacuum_max_workers + 1 +
+		max_worker_processes;
+#endif
+}
+
+Size
+ProgressSlotsShmemSize(void)
+{
+	return mul_size(ProgressSlotsCount(), sizeof(pg_qs_progress_slot));
+}
+
+/*
+ * Walker collecting rows of the topmost plan nodes and number of launched
+ * parallel workers
+ */
+static bool
+summarize_node(PlanState *planstate, progress_summary *summary)
+{
+	Instrumentation *instr;
+
+	if (planstate == NULL)
+		return false;
+
+	instr = planstate->instrument;
+	if (instr && summary->nnodes < PG_QS_PROGRESS_NODES)
+	{
+		pg_qs_progress_node *node = &summary->nodes[summary->nnodes++];
+
+		node->plan_node_id = planstate->plan->plan_node_id;
+		node->rows = instr->ntuples + instr->tuplecount;
+	}
+
+	switch (nodeTag(planstate))
+	{
+		case T_GatherState:
+#if PG_VERSION_NUM >= 100000
+			summary->nworkers += ((GatherState *) planstate)->nworkers_launched;
+#else
+			if (((GatherState *) planstate)->pei)
+				summary->nworkers +=
+					((GatherState *) planstate)->pei->pcxt->nworkers_launched;
+#endif
+			break;
+#if PG_VERSION_NUM >= 100000
+		case T_GatherMergeState:
+			summary->nworkers += ((GatherMergeState *) planstate)->nworkers_launched;
+			break;
+#endif
+		default:
+			break;
+	}
+
+	return planstate_tree_walker(planstate, summarize_node, (void *) summary);
+}
+
+/*
+ * Write summary of query to slot of current backend, or clear the slot if
+ * queryDesc is NULL.
+ *		Readers don't take any locks, they retry reading while change counter
+ *		is odd or differs before and after copying of slot.
+ */
+static void
+write_progress_slot(QueryDesc *queryDesc)
+{
+	volatile pg_qs_progress_slot *slot = my_slot;
+	progress_summary summary;
+	double		progress = -1;
+	int			i;
+
+	summary.nnodes = 0;
+	summary.nworkers = 0;
+	if (queryDesc && queryDesc->planstate)
+	{
+		summarize_node(queryDesc->planstate, &summary);
+		progress = PlanProgress(queryDesc->planstate);
+	}
+
+	slot->changecount++;
+	pg_write_barrier();
+
+	if (queryDesc)
+	{
+		slot->pid = MyProcPid;
+		slot->userid = GetUserId();
+		slot->dbid = MyDatabaseId;
+		slot->query_id = (int64) queryDesc->plannedstmt->queryId;
+		slot->query_start = published_query_start;
+		slot->updated = GetCurrentTimestamp();
+		slot->progress = progress;
+		slot->nworkers = summary.nworkers;
+		slot->nnodes = summary.nnodes;
+		for (i = 0; i < summary.nnodes; i++)
+		{
+			slot->nodes[i].plan_node_id = summary.nodes[i].plan_node_id;
+			slot->nodes[i].rows = summary.nodes[i].rows;
+		}
+	}
+	else
+		slot->pid = 0;
+
+	pg_write_barrier();
+	slot->changecount++;
+}
+
+static void
+clear_progress_slot(int code, Datum arg)
+{
+	if (published_query)
+	{
+		published_query = NULL;
+		write_progress_slot(NULL);
+	}
+}
+
+/*
+ * Timeout handler, runs in signal context. Only raise the flag, the slot is
+ * refreshed by the backend itself when the executor calls the next plan node.
+ */
+static void
+progress_timeout_handler(void)
+{
+	ProgressUpdatePending = true;
+}
+
+#if PG_VERSION_NUM >= 100000
+/*
+ * ExecProcNode wrapper refreshing the slot when the timer has fired.
+ *		Custom signal pendings are private to core, so there is no way to get
+ *		control at CHECK_FOR_INTERRUPTS without signalling ourselves, and a
+ *		plan node call is the nearest point the executor passes regularly.
+ */
+static TupleTableSlot *
+qs_ExecProcNodeProgress(PlanState *node)
+{
+	Instrumentation	   *instr = node->instrument;
+	TupleTableSlot	   *result;
+
+	if (ProgressUpdatePending)
+		UpdateProgressSlot();
+
+	/* the same check as in ExecProcNodeFirst that we may have replaced */
+	if (instr == NULL || !instr->running)
+		check_stack_depth();
+
+	if (instr == NULL)
+		return node->ExecProcNodeReal(node);
+
+	InstrStartNode(instr);
+	result = node->ExecProcNodeReal(node);
+	InstrStopNode(instr, TupIsNull(result) ? 0.0 : 1.0);
+
+	return result;
+}
+
+/*
+ * Replace ExecProcNode of every plan node by wrapper checking the timer,
+ * nodes with sampled timing check it by themselves.
+ */
+static bool
+install_progress_update(PlanState *node, void *context)
+{
+	if (node == NULL)
+		return false;
+
+	if (node->ExecProcNode != qs_ExecProcNodeProgress && !IsTimingSampled(node))
+		node->ExecProcNode = qs_ExecProcNodeProgress;
+
+	return planstate_tree_walker(node, install_progress_update, context);
+}
+#endif
+
+/*
+ * Start publishing progress of the outermost query of backend
+ */
+void
+StartProgressReport(QueryDesc *queryDesc)
+{
+	int			slotno;
+
+	if (!pg_qs_enable
+		|| pg_qs_progress_update_interval <= 0
+		|| progress_slots == NULL
+		|| IsParallelWorker()
+		|| MyProc == NULL)
+		return;
+
+	if (my_slot == NULL)
+	{
+		slotno = MyProc - ProcGlobal->allProcs;
+		if (slotno < 0 || slotno >= ProgressSlotsCount())
+			return;
+		my_slot = &progress_slots[slotno];
+		on_shmem_exit(clear_progress_slot, (Datum) 0);
+	}
+
+	if (!progress_timeout_registered)
+	{
+		progress_timeout = RegisterTimeout(USER_TIMEOUT, progress_timeout_handler);
+		progress_timeout_registered = true;
+	}
+
+#if PG_VERSION_NUM >= 100000
+	if (queryDesc->planstate)
+		install_progress_update(queryDesc->planstate, NULL);
+#endif
+
+	published_query = queryDesc;
+	published_query_start = GetCurrentStatementStartTimestamp();
+	ProgressUpdatePending = false;
+	write_progress_slot(queryDesc);
+	enable_timeout_after(progress_timeout, pg_qs_progress_update_interval);
+}
+
+/*
+ * Stop publishing progress when the outermost query leaves executor
+ */
+void
+StopProgressReport(void)
+{
+	if (published_query == NULL)
+		return;
+
+	disable_timeout(progress_timeout, false);
+	ProgressUpdatePending = false;
+	published_query = NULL;
+	write_progress_slot(NULL);
+}
+
+/*
+ * Refresh the slot after the timer has fired and rearm timer
+ */
+void
+UpdateProgressSlot(void)
+{
+	ProgressUpdatePending = false;
+	if (published_query == NULL)
+		return;
+
+	write_progress_slot(published_query);
+	if (pg_qs_progress_update_interval > 0)
+		enable_timeout_after(progress_timeout, pg_qs_progress_update_interval);
+}
+
+/*
+ * Copy consistent contents of slot, return false if the slot is free
+ */
+static bool
+read_progress_slot(volatile pg_qs_progress_slot *slot, pg_qs_progress_slot *copy)
+{
+	for (;;)
+	{
+		uint32		before_changecount = slot->changecount;
+		uint32		after_changecount;
+
+		pg_read_barrier();
+		memcpy(copy, (pg_qs_progress_slot *) slot, sizeof(pg_qs_progress_slot));
+		pg_read_barrier();
+		after_changecount = slot->changecount;
+
+		if (before_changecount == after_changecount
+			&& (before_changecount & 1) == 0)
+			break;
+
+		/* writer is in the middle of update, try again */
+		CHECK_FOR_INTERRUPTS();
+	}
+
+	return copy->pid != 0;
+}
+
+#define N_PROGRESS_ATTRS	10
+
+PG_FUNCTION_INFO_V1(pg_query_progress);
+Datum
+pg_query_progress(PG_FUNCTION_ARGS)
+{
+	FuncCallContext	*funcctx;
+	int				*slotno;
+	pg_qs_progress_slot slot;
+
+	if (SRF_IS_FIRSTCALL())
+	{
+		MemoryContext	oldcontext;
+		TupleDesc		tupdesc;
+
+		if (progress_slots == NULL)
+			ereport(ERROR, (errcode(ERRCODE_FEATURE_NOT_SUPPORTED),
+							errmsg("pg_query_state wasn't initialized yet")));
+
+		funcctx = SRF_FIRSTCALL_INIT();
+		oldcontext = MemoryContextSwitchTo(funcctx->multi_call_memory_ctx);
+
+		if (get_call_result_type(fcinfo, NULL, &tupdesc) != TYPEFUNC_COMPOSITE)
+			elog(ERROR, "return type must be a row type");
+		funcctx->tuple_desc = BlessTupleDesc(tupdesc);
+		funcctx->user_fctx = palloc0(sizeof(int));
+
+		MemoryContextSwitchTo(oldcontext);
+	}
+
+	funcctx = SRF_PERCALL_SETUP();
+	slotno = (int *) funcctx->user_fctx;
+
+	while (*slotno < ProgressSlotsCount())
+	{
+		Datum		values[N_PROGRESS_ATTRS];
+		bool		nulls[N_PROGRESS_ATTRS];
+		Datum	   *node_ids;
+		Datum	   *node_rows;
+		HeapTuple	tuple;
+		int			i;
+
+		if (!read_progress_slot(&progress_slots[(*slotno)++], &slot))
+			continue;
+		if (!has_privs_of_role(GetUserId(), slot.userid))
+			continue;
+
+		MemSet(nulls, 0, sizeof(nulls));
+		values[0] = Int32GetDatum(slot.pid);
+		values[1] = ObjectIdGetDatum(slot.dbid);
+		values[2] = ObjectIdGetDatum(slot.userid);
+		values[3] = Int64GetDatum(slot.query_id);
+		values[4] = TimestampTzGetDatum(slot.query_start);
+		values[5] = TimestampTzGetDatum(slot.updated);
+		if (slot.progress >= 0)
+			values[6] = Float8GetDatum(slot.progress);
+		else
+			nulls[6] = true;
+		values[7] = Int32GetDatum(slot.nworkers);
+
+		node_ids = palloc(sizeof(Datum) * Max(slot.nnodes, 1));
+		node_rows = palloc(sizeof(Datum) * Max(slot.nnodes, 1));
+		for (i = 0; i < slot.nnodes; i++)
+		{
+			node_ids[i] = Int32GetDatum(slot.nodes[i].plan_node_id);
+			node_rows[i] = Float8GetDatum(slot.nodes[i].rows);
+		}
+		values[8] = PointerGetDatum(construct_array(node_ids, slot.nnodes,
+													INT4OID, sizeof(int32),
+													true, 'i'));
+		values[9] = PointerGetDatum(construct_array(node_rows, slot.nnodes,
+													FLOAT8OID, sizeof(float8),
+													FLOAT8PASSBYVAL, 'd'));
+
+		tuple = heap_form_tuple(funcctx->tuple_desc, values, nulls);
+		SRF_RETURN_NEXT(funcctx, HeapTupleGetDatum(tuple));
+	}
+
+	SRF_RETURN_DONE(funcctx);
+}
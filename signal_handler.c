@@ -10,6 +10,7 @@
 
 #include "pg_query_state.h"
 
+#include "access/parallel.h"
 #include "commands/explain.h"
 #if PG_VERSION_NUM >= 180000
 #include "commands/explain_state.h"
@@ -19,7 +20,10 @@
 #if PG_VERSION_NUM >= 100000
 #include "pgstat.h"
 #endif
+#include "mb/pg_wchar.h"
+#include "nodes/nodeFuncs.h"
 #include "utils/builtins.h"
+#include "utils/json.h"
 #include "utils/memutils.h"
 
 /*
@@ -27,49 +31,287 @@
  */
 typedef struct
 {
+	int			 frame_number;
 	const char	*query;
 	char		*plan;
+	int			 plan_len;		/* counters of nodes are binary */
 } stack_frame;
 
+/*
+ * Context of search of plan node by plan_node_id
+ */
+typedef struct
+{
+	int			 node_id;
+	PlanState	*result;
+} find_node_context;
+
+#if PG_VERSION_NUM >= 130000
+/*
+ * Children of plan node hidden from EXPLAIN by depth limit
+ */
+typedef struct
+{
+	PlanState	*planstate;
+	PlanState	*lefttree;
+	PlanState	*righttree;
+	List		*initPlan;
+	List		*subPlan;
+	List		*custom_ps;
+	int			 nplans;
+} pruned_node;
+
+typedef struct
+{
+	int		 depth;
+	int		 max_depth;
+	List	*pruned;
+} prune_context;
+#endif
+
+/*
+ * Find state of plan node with plan_node_id equal to context->node_id
+ */
+static bool
+find_plan_node(PlanState *planstate, find_node_context *context)
+{
+	if (planstate == NULL)
+		return false;
+
+	if (planstate->plan->plan_node_id == context->node_id)
+	{
+		context->result = planstate;
+		return true;
+	}
+
+	return planstate_tree_walker(planstate, find_plan_node, (void *) context);
+}
+
+#if PG_VERSION_NUM >= 130000
+/*
+ * Detach children of nodes lying at the depth limit so that EXPLAIN stops
+ * there, detached children are saved into context->pruned to be restored by
+ * restore_plan_tree().
+ *		Members of Append, MergeAppend and SubqueryScan nodes can't be detached
+ *		without breaking EXPLAIN output, so they are printed one level deeper
+ *		but with their own children detached.
+ */
+static bool
+prune_plan_tree(PlanState *planstate, prune_context *context)
+{
+	bool	result;
+
+	if (planstate == NULL)
+		return false;
+
+	if (context->depth >= context->max_depth)
+	{
+		pruned_node *node = palloc0(sizeof(pruned_node));
+
+		node->planstate = planstate;
+		node->lefttree = planstate->lefttree;
+		node->righttree = planstate->righttree;
+		node->initPlan = planstate->initPlan;
+		node->subPlan = planstate->subPlan;
+		planstate->lefttree = NULL;
+		planstate->righttree = NULL;
+		planstate->initPlan = NIL;
+		planstate->subPlan = NIL;
+
+		if (IsA(planstate, CustomScanState))
+		{
+			node->custom_ps = ((CustomScanState *) planstate)->custom_ps;
+			((CustomScanState *) planstate)->custom_ps = NIL;
+		}
+		else if (IsA(planstate, BitmapAndState))
+		{
+			node->nplans = ((BitmapAndState *) planstate)->nplans;
+			((BitmapAndState *) planstate)->nplans = 0;
+		}
+		else if (IsA(planstate, BitmapOrState))
+		{
+			node->nplans = ((BitmapOrState *) planstate)->nplans;
+			((BitmapOrState *) planstate)->nplans = 0;
+		}
+
+		context->pruned = lappend(context->pruned, node);
+	}
+
+	context->depth++;
+	result = planstate_tree_walker(planstate, prune_plan_tree, (void *) context);
+	context->depth--;
+
+	return result;
+}
+
+/*
+ * Attach back children detached by prune_plan_tree()
+ */
+static void
+restore_plan_tree(List *pruned)
+{
+	ListCell	*i;
+
+	foreach(i, pruned)
+	{
+		pruned_node *node = (pruned_node *) lfirst(i);
+		PlanState	*planstate = node->planstate;
+
+		planstate->lefttree = node->lefttree;
+		planstate->righttree = node->righttree;
+		planstate->initPlan = node->initPlan;
+		planstate->subPlan = node->subPlan;
+
+		if (IsA(planstate, CustomScanState))
+			((CustomScanState *) planstate)->custom_ps = node->custom_ps;
+		else if (IsA(planstate, BitmapAndState))
+			((BitmapAndState *) planstate)->nplans = node->nplans;
+		else if (IsA(planstate, BitmapOrState))
+			((BitmapOrState *) planstate)->nplans = node->nplans;
+	}
+	list_free_deep(pruned);
+}
+#endif
+
+/*
+ * Print plan of query into es->str, limited by qs_params->depth
+ */
+static void
+print_plan(ExplainState *es, QueryDesc *queryDesc, pg_qs_params *qs_params)
+{
+#if PG_VERSION_NUM >= 130000
+	prune_context	context;
+	PlanState		*root = queryDesc->planstate;
+
+	if (qs_params->depth < 0)
+	{
+		ExplainPrintPlan(es, queryDesc);
+		return;
+	}
+
+	/*
+	 * EXPLAIN starts from the child of invisible Gather added by
+	 * debug_parallel_query, so does the depth count, and the child must not
+	 * be detached
+	 */
+	if (IsA(root, GatherState) && ((Gather *) root->plan)->invisible)
+		root = outerPlanState(root);
+
+	context.depth = 0;
+	context.max_depth = qs_params->depth;
+	context.pruned = NIL;
+	prune_plan_tree(root, &context);
+
+	/* plan tree belongs to running query, it must be restored in any case */
+	PG_TRY();
+	{
+		ExplainPrintPlan(es, queryDesc);
+	}
+	PG_CATCH();
+	{
+		restore_plan_tree(context.pruned);
+		PG_RE_THROW();
+	}
+	PG_END_TRY();
+	restore_plan_tree(context.pruned);
+#else
+	/* depth limit is rejected on requestor side for these versions */
+	ExplainPrintPlan(es, queryDesc);
+#endif
+}
+
 /*
  *	Get List of stack_frames as a stack of function calls starting from outermost call.
  *		Each entry contains query text and query state in form of EXPLAIN ANALYZE output.
- *	Assume extension is enabled and QueryDescStack is not empty
+ *		Only frames selected by qs_params->frame are printed, and if
+ *		qs_params->node_id is set only subtrees rooted at that plan node, frames
+ *		without such node are skipped.
+ *	Assume extension is enabled and query_desc_stack is not empty
  */
 static List *
-runtime_explain()
+runtime_explain(List *query_desc_stack, pg_qs_params *qs_params)
 {
 	ExplainState    *es;
 	ListCell	    *i;
 	List			*result = NIL;
+	int				 frame_number = list_length(query_desc_stack);
 
-	Assert(list_length(QueryDescStack) > 0);
+	Assert(list_length(query_desc_stack) > 0);
 
 	/* initialize explain state with all config parameters */
 	es = NewExplainState();
 	es->analyze = true;
-	es->verbose = params->verbose;
-	es->costs = params->costs;
-	es->buffers = params->buffers && pg_qs_buffers;
-	es->timing = params->timing && pg_qs_timing;
+	es->verbose = qs_params->verbose;
+	es->costs = qs_params->costs;
+	es->buffers = qs_params->buffers && pg_qs_buffers;
+	es->timing = qs_params->timing && pg_qs_timing;
 	es->summary = false;
-	es->format = params->format;
+	es->format = qs_params->format;
 	es->runtime = true;
 
 	/* collect query state outputs of each plan entry of stack */
-	foreach(i, QueryDescStack)
+	foreach(i, query_desc_stack)
 	{
 		QueryDesc 	*currentQueryDesc = (QueryDesc *) lfirst(i);
-		stack_frame	*qs_frame = palloc(sizeof(stack_frame));
+		QueryDesc	*explainQueryDesc = currentQueryDesc;
+		stack_frame	*qs_frame;
+
+		/* stack is iterated from innermost call */
+		frame_number--;
+		if (qs_params->frame == PG_QS_FRAME_INNERMOST)
+		{
+			if (i != list_head(query_desc_stack))
+				continue;
+		}
+		else if (qs_params->frame != PG_QS_FRAME_ALL
+				 && qs_params->frame != frame_number)
+			continue;
+
+		/* print subtree through copy of query descriptor with different root */
+		if (qs_params->node_id >= 0)
+		{
+			find_node_context context;
+
+			context.node_id = qs_params->node_id;
+			context.result = NULL;
+			if (!find_plan_node(currentQueryDesc->planstate, &context))
+				continue;
+
+			explainQueryDesc = palloc(sizeof(QueryDesc));
+			memcpy(explainQueryDesc, currentQueryDesc, sizeof(QueryDesc));
+			explainQueryDesc->planstate = context.result;
+		}
+
+		qs_frame = palloc(sizeof(stack_frame));
+		qs_frame->frame_number = frame_number;
 
 		/* save query text */
 		qs_frame->query = currentQueryDesc->sourceText;
 
+		/* requestor counts itself on raw counters of nodes */
+		if (qs_params->counters)
+		{
+			qs_frame->plan = PlanCounters(currentQueryDesc,
+										  explainQueryDesc->planstate,
+										  &qs_frame->plan_len);
+			result = lcons(qs_frame, result);
+			continue;
+		}
+
 		/* save plan with statistics */
 		initStringInfo(es->str);
 		ExplainBeginOutput(es);
-		ExplainPrintPlan(es, currentQueryDesc);
-		if (params->triggers)
+		print_plan(es, explainQueryDesc, qs_params);
+		if (es->timing && IsTimingSampled(currentQueryDesc->planstate))
+			ExplainPropertyText("Timing Mode",
+								psprintf("sampled every %d rows, estimated",
+										 Max(pg_qs_timing_sample_rate, 1)),
+								es);
+		if (qs_params->progress)
+			PrintProgress(es, explainQueryDesc->planstate);
+		if (qs_params->memory)
+			PrintMemoryUsage(es, currentQueryDesc, explainQueryDesc->planstate);
+		if (qs_params->triggers)
 			ExplainPrintTriggers(es, currentQueryDesc);
 		ExplainEndOutput(es);
 
@@ -78,13 +320,14 @@ runtime_explain()
 			es->str->data[--es->str->len] = '\0';
 
 		/* Fix JSON to output an object */
-		if (params->format == EXPLAIN_FORMAT_JSON)
+		if (qs_params->format == EXPLAIN_FORMAT_JSON)
 		{
 			es->str->data[0] = '{';
 			es->str->data[es->str->len - 1] = '}';
 		}
 
 		qs_frame->plan = es->str->data;
+		qs_frame->plan_len = es->str->len;
 
 		result = lcons(qs_frame, result);
 	}
@@ -98,8 +341,9 @@ runtime_explain()
 static int
 serialized_stack_frame_length(stack_frame *qs_frame)
 {
-	return 	INTALIGN(strlen(qs_frame->query) + VARHDRSZ)
-		+ 	INTALIGN(strlen(qs_frame->plan) + VARHDRSZ);
+	return 	sizeof(int)
+		+	INTALIGN(strlen(qs_frame->query) + VARHDRSZ)
+		+ 	INTALIGN(qs_frame->plan_len + VARHDRSZ);
 }
 
 /*
@@ -128,12 +372,15 @@ serialized_stack_length(List *qs_stack)
 static void
 serialize_stack_frame(char **dest, stack_frame *qs_frame)
 {
+	memcpy(*dest, &qs_frame->frame_number, sizeof(int));
+	*dest += sizeof(int);
+
 	SET_VARSIZE(*dest, strlen(qs_frame->query) + VARHDRSZ);
 	memcpy(VARDATA(*dest), qs_frame->query, strlen(qs_frame->query));
 	*dest += INTALIGN(VARSIZE(*dest));
 
-	SET_VARSIZE(*dest, strlen(qs_frame->plan) + VARHDRSZ);
-	memcpy(VARDATA(*dest), qs_frame->plan, strlen(qs_frame->plan));
+	SET_VARSIZE(*dest, qs_frame->plan_len + VARHDRSZ);
+	memcpy(VARDATA(*dest), qs_frame->plan, qs_frame->plan_len);
 	*dest += INTALIGN(VARSIZE(*dest));
 }
 
@@ -251,9 +498,18 @@ SendQueryState(void)
 	/* happy path */
 	else
 	{
-		List			*qs_stack = runtime_explain();
-		int				msglen = sizeof(shm_mq_msg) + serialized_stack_length(qs_stack);
-		shm_mq_msg		*msg = palloc(msglen);
+		pg_qs_params	 qs_params = *params;
+		List			*qs_stack;
+		int				 msglen;
+		shm_mq_msg		*msg;
+
+		/* frames are numbered by stack of leader, worker runs only one */
+		if (IsParallelWorker())
+			qs_params.frame = PG_QS_FRAME_ALL;
+
+		qs_stack = runtime_explain(QueryDescStack, &qs_params);
+		msglen = sizeof(shm_mq_msg) + serialized_stack_length(qs_stack);
+		msg = palloc(msglen);
 
 		msg->reqid = *mq_req_id;
 		msg->length = msglen;
@@ -315,3 +571,74 @@ SendCurrentUserId(void)
 #endif
 	UnlockShmem(&tag);
 }
+
+/*
+ * Write state of the query being interrupted to server log.
+ *		All frames of query_desc_stack are printed in specified format, the
+ *		output is cut off at max_size bytes.
+ */
+void
+LogQueryState(List *query_desc_stack, ExplainFormat format, int max_size,
+			  const char *reason)
+{
+	pg_qs_params	qs_params;
+	List		   *qs_stack;
+	ListCell	   *i;
+	StringInfoData	buf;
+	int				frame_number = 0;
+
+	/* timing and buffers are printed if they are collected at all */
+	MemSet(&qs_params, 0, sizeof(qs_params));
+	qs_params.timing = true;
+	qs_params.buffers = true;
+	qs_params.format = format;
+	qs_params.frame = PG_QS_FRAME_ALL;
+	qs_params.node_id = -1;
+	qs_params.depth = -1;
+	qs_params.memory = false;
+	qs_params.progress = false;
+	qs_params.counters = false;
+
+	qs_stack = runtime_explain(query_desc_stack, &qs_params);
+
+	initStringInfo(&buf);
+	if (format == EXPLAIN_FORMAT_JSON)
+		appendStringInfoChar(&buf, '[');
+	foreach(i, qs_stack)
+	{
+		stack_frame *qs_frame = (stack_frame *) lfirst(i);
+
+		if (format == EXPLAIN_FORMAT_JSON)
+		{
+			if (frame_number > 0)
+				appendStringInfoChar(&buf, ',');
+			appendStringInfo(&buf, "\n{\"Frame Number\": %d, \"Query Text\": ",
+							 qs_frame->frame_number);
+			escape_json(&buf, qs_frame->query);
+			appendStringInfo(&buf, ", \"Query State\": %s}", qs_frame->plan);
+		}
+		else
+			appendStringInfo(&buf, "%sframe %d: %s\n%s",
+							 frame_number > 0 ? "\n" : "",
+							 qs_frame->frame_number, qs_frame->query,
+							 qs_frame->plan);
+		frame_number++;
+	}
+	if (format == EXPLAIN_FORMAT_JSON)
+		appendStringInfoString(&buf, "\n]");
+
+	if (buf.len > max_size)
+	{
+		buf.len = pg_mbcliplen(buf.data, buf.len, max_size);
+		buf.data[buf.len] = '\0';
+		appendStringInfoString(&buf, "\n... (truncated)");
+	}
+
+	ereport(LOG_SERVER_ONLY,
+			(errmsg("pg_query_state: state of query interrupted with \"%s\"", reason),
+			 errdetail_internal("%s", buf.data),
+			 errhidestmt(true)));
+
+	list_free_deep(qs_stack);
+	pfree(buf.data);
+}
@@ -0,0 +1,104 @@
+# pg_query_state/t/002_log_on_cancel.pl
+#
+# Check state of query written to server log by pg_query_state.log_on_cancel
+# when query is interrupted by statement_timeout
+
+use strict;
+use warnings;
+use Test::More tests => 10;
+
+# List of checks:
+#     1) state in text format
+#     2) state in json format
+#     3) truncation of state by log_on_cancel_max_size
+
+my $node;
+
+# modules depend on the PostgreSQL version
+my $pg_15_modules;
+
+BEGIN
+{
+	$pg_15_modules = eval
+	{
+		require PostgreSQL::Test::Cluster;
+		require PostgreSQL::Test::Utils;
+		return 1;
+	};
+
+	unless (defined $pg_15_modules)
+	{
+		$pg_15_modules = 0;
+
+		require PostgresNode;
+		require TestLib;
+	}
+}
+
+note('PostgreSQL 15 modules are used: ' . ($pg_15_modules ? 'yes' : 'no'));
+
+if ($pg_15_modules)
+{
+	$node = PostgreSQL::Test::Cluster->new("master");
+}
+else
+{
+	$node = PostgresNode->get_new_node("master");
+}
+
+$node->init;
+$node->append_conf('postgresql.conf', "shared_preload_libraries = 'pg_query_state'");
+$node->start;
+$node->safe_psql('postgres', 'CREATE EXTENSION pg_query_state;');
+
+my $long_query = 'SELECT count(*) FROM generate_series(1, 100000000) AS g';
+my $interrupted = qr/pg_query_state: state of query interrupted with "canceling statement due to statement timeout"/;
+
+# run query until statement timeout with specified settings of log_on_cancel,
+# return error of query and server log written meanwhile
+sub run_interrupted
+{
+	my ($format, $max_size, $query) = @_;
+	my $offset = -s $node->logfile;
+	my $stderr;
+
+	$node->psql('postgres',
+				"SET pg_query_state.log_on_cancel = $format;\n"
+				. "SET pg_query_state.log_on_cancel_max_size = '$max_size';\n"
+				. "SET statement_timeout = 500;\n"
+				. "$query;",
+				stderr => \$stderr);
+
+	my $log = $pg_15_modules
+		? PostgreSQL::Test::Utils::slurp_file($node->logfile)
+		: TestLib::slurp_file($node->logfile);
+	return ($stderr, substr($log, $offset));
+}
+
+my ($stderr, $log);
+
+note('State in text format');
+($stderr, $log) = run_interrupted('text', '64kB', $long_query);
+like($stderr, qr/ERROR:  canceling statement due to statement timeout/,
+	 "original error is reported to client");
+like($log, $interrupted, "state of interrupted query is logged");
+like($log, qr/DETAIL:  frame 0: \Q$long_query\E/,
+	 "text state starts with the outermost frame");
+like($log, qr/Aggregate \(Current loop: /, "text state contains plan");
+
+note('State in json format');
+($stderr, $log) = run_interrupted('json', '64kB', $long_query);
+like($log, $interrupted, "state of interrupted query is logged");
+like($log, qr/\{"Frame Number": 0, "Query Text": "\Q$long_query\E/,
+	 "json state starts with the outermost frame");
+like($log, qr/"Node Type": "Aggregate"/, "json state contains plan");
+unlike($log, qr/\.\.\. \(truncated\)/, "state within limit is not truncated");
+
+note('Truncation of state');
+# query text alone exceeds the limit
+my $padded_query = $long_query . ' /* ' . ('x' x 2048) . ' */';
+($stderr, $log) = run_interrupted('text', '1kB', $padded_query);
+like($log, $interrupted, "state of interrupted query is logged");
+like($log, qr/x\n\.\.\. \(truncated\)/, "state over limit is truncated");
+
+$node->stop('fast');
@@ -11,6 +11,13 @@ import time
 BACKEND_IS_IDLE_INFO = 'INFO:  state of backend is idle\n'
 BACKEND_IS_ACTIVE_INFO = 'INFO:  state of backend is active\n'
 
+# limits of waiting for running query to be seen by pg_query_state, number of
+# attempts is bounded rather than time, as attempts of concurrent tests may be
+# slowed down waiting for each other
+MIN_RETRY_DELAY = 0.005
+MAX_RETRY_DELAY = 0.1
+MAX_RETRIES = 15
+
 def wait(conn):
 	"""wait for some event on connection to postgres"""
 	while 1:
@@ -24,6 +31,26 @@ def wait(conn):
 		else:
 			raise psycopg2.OperationalError("poll() returned %s" % state)
 
+def retry_while_running(async_conn, attempt, done=lambda result: len(result[0]) > 0):
+	"""
+	Call 'attempt' until 'done' accepts its result or query running on
+	'async_conn' completes, at most MAX_RETRIES times. Between attempts wait
+	for reply on the connection instead of sleeping, with delay growing from
+	MIN_RETRY_DELAY
+	"""
+
+	delay = MIN_RETRY_DELAY
+	for n_retries in range(1, MAX_RETRIES + 1):
+		result = attempt()
+		if done(result) or n_retries == MAX_RETRIES:
+			break
+		r, _, _ = select.select([async_conn.fileno()], [], [], delay)
+		if r and async_conn.poll() == psycopg2.extensions.POLL_OK:
+			# query has completed, there is nothing to wait for
+			break
+		delay = min(delay * 2, MAX_RETRY_DELAY)
+	return result
+
 def n_async_connect(config, n=1):
 	"""establish n asynchronious connections to the postgres with specified config"""
 
@@ -44,14 +71,17 @@ def n_close(conns):
 		conn.close()
 
 def pg_query_state_locks(config, pid, conn, verbose=False, costs=False, timing=False, \
-								buffers=False, triggers=False, format='text'):
+								buffers=False, triggers=False, format='text', \
+								frame='all', node_id=-1, depth=-1, memory=False, \
+								progress=False):
 	"""
 	Get query state from backend with specified pid and optional parameters.
 	Save any warning, info, notice and log data in global variable 'notices'
 	"""
 
 	curs = conn.cursor()
-	curs.callproc('pg_query_state', (pid, verbose, costs, timing, buffers, triggers, format))
+	curs.callproc('pg_query_state', (pid, verbose, costs, timing, buffers, triggers, format,
+									 frame, node_id, depth, memory, progress))
 	wait(conn)
 	result = curs.fetchall()
 	notices = conn.notices[:]
@@ -59,7 +89,9 @@ def pg_query_state_locks(config, pid, conn, verbose=False, costs=False, timing=F
 	return result, notices
 
 def pg_query_state(config, pid, verbose=False, costs=False, timing=False, \
-								buffers=False, triggers=False, format='text'):
+								buffers=False, triggers=False, format='text', \
+								frame='all', node_id=-1, depth=-1, memory=False, \
+								progress=False):
 	"""
 	Get query state from backend with specified pid and optional parameters.
 	Save any warning, info, notice and log data in global variable 'notices'
@@ -67,7 +99,8 @@ def pg_query_state(config, pid, verbose=False, costs=False, timing=False, \
 
 	conn = psycopg2.connect(**config)
 	curs = conn.cursor()
-	curs.callproc('pg_query_state', (pid, verbose, costs, timing, buffers, triggers, format))
+	curs.callproc('pg_query_state', (pid, verbose, costs, timing, buffers, triggers, format,
+									 frame, node_id, depth, memory, progress))
 	result = curs.fetchall()
 	notices = conn.notices[:]
 	conn.close()
@@ -80,6 +113,14 @@ def onetime_query_state_locks(config, acon_query, acon_pg, query, args={}, num_w
 	of node executions from start of query
 	"""
 
+	return query_states_locks(config, acon_query, acon_pg, query, [args], num_workers)[0]
+
+def query_states_locks(config, acon_query, acon_pg, query, args_list, num_workers=0):
+	"""
+	Get intermediate states of 'query' on connection 'acon_query' blocked at
+	the same point, one for each arguments of 'args_list'
+	"""
+
 	curs_query = acon_query.cursor()
 	curs_pg = acon_pg.cursor()
 	curs_query.execute("select pg_advisory_lock(1);")
@@ -90,40 +131,194 @@ def onetime_query_state_locks(config, acon_query, acon_pg, query, args={}, num_w
 	set_guc(acon_query, 'enable_mergejoin', 'off')
 	set_guc(acon_query, 'max_parallel_workers_per_gather', num_workers)
 	curs_query.execute(query)
+
+	wait(acon_pg)
+
 	# extract current state of query progress
-	MAX_PG_QS_RETRIES = 10
-	DELAY_BETWEEN_RETRIES = 0.1
-	pg_qs_args = {
-			'config': config,
-			'pid': acon_query.get_backend_pid(),
-			'conn': acon_pg
-			}
-	for k, v in args.items():
-		pg_qs_args[k] = v
-	n_retries = 0
+	results = []
+	for args in args_list:
+		pg_qs_args = {
+				'config': config,
+				'pid': acon_query.get_backend_pid(),
+				'conn': acon_pg
+				}
+		for k, v in args.items():
+			pg_qs_args[k] = v
+		results.append(retry_while_running(acon_query,
+										   lambda: pg_query_state_locks(**pg_qs_args)))
 
+	curs_pg.execute("select pg_advisory_unlock(2);")
 	wait(acon_pg)
+	wait(acon_query)
 
-	while True:
-		result, notices = pg_query_state_locks(**pg_qs_args)
-		n_retries += 1
-		if len(result) > 0:
-			break
-		if n_retries >= MAX_PG_QS_RETRIES:
-			# pg_query_state callings don't return any result, more likely run
-			# query has completed
-			break
-		time.sleep(DELAY_BETWEEN_RETRIES)
+	set_guc(acon_query, 'enable_mergejoin', 'on')
+	curs_query.execute("select pg_advisory_unlock(2);")
+	curs_pg.execute("select pg_advisory_unlock(1);")
+	return results
+
+def query_progress(conn, pid):
+	"""Read progress published by backend with specified pid to shared memory"""
+
+	curs = conn.cursor()
+	curs.execute('select progress, workers, node_ids, node_rows from pg_query_progress where pid = %s', (pid,))
+	wait(conn)
+	return curs.fetchall()
+
+def onetime_query_progress(config, acon_query, acon_pg, query, interval=10):
+	"""
+	Get progress of 'query' on connection 'acon_query' published to shared
+	memory while query is blocked after build of hash table
+	"""
+
+	curs_query = acon_query.cursor()
+	curs_pg = acon_pg.cursor()
+	curs_query.execute("select pg_advisory_lock(1);")
+	curs_pg.execute("select pg_advisory_lock(2);")
+	wait(acon_query)
+	wait(acon_pg)
+	curs_pg.execute("select pg_advisory_lock(1);")
+	set_guc(acon_query, 'enable_mergejoin', 'off')
+	set_guc(acon_query, 'max_parallel_workers_per_gather', 0)
+	set_guc(acon_query, 'pg_query_state.progress_update_interval', interval)
+	curs_query.execute(query)
+	wait(acon_pg)
+
+	# wait for the first refresh of progress after start of query
+	pid = acon_query.get_backend_pid()
+	result = retry_while_running(acon_query,
+								 lambda: query_progress(acon_pg, pid),
+								 lambda result: len(result) > 0 and result[0][0])
 
 	curs_pg.execute("select pg_advisory_unlock(2);")
 	wait(acon_pg)
 	wait(acon_query)
 
+	finished = query_progress(acon_pg, pid)
+
 	set_guc(acon_query, 'enable_mergejoin', 'on')
+	set_guc(acon_query, 'pg_query_state.progress_update_interval', 0)
 	curs_query.execute("select pg_advisory_unlock(2);")
+	wait(acon_query)
 	curs_pg.execute("select pg_advisory_unlock(1);")
+	wait(acon_pg)
+	return result, finished
+
+def query_watch(config, pid, ticks, delay):
+	"""Take first 'ticks' rows streamed by pg_query_state_watch"""
+
+	conn = psycopg2.connect(**config)
+	curs = conn.cursor()
+
+	# calling function in target list lets LIMIT stop it, in FROM it would
+	# run until the end of query
+	curs.execute("""select (w).ts, (w).progress, (w).rows_processed,
+						   (w).rows_per_sec, (w).workers
+					  from (select pg_query_state_watch(%s, %s) w limit %s) s""",
+				 (pid, delay, ticks))
+	result = curs.fetchall()
+	notices = conn.notices[:]
+	conn.close()
+
 	return result, notices
 
+def query_watch_parallel(config, async_conn, query, num_workers, delay=0.05):
+	"""
+	Watch progress of parallel 'query' on connection 'async_conn' until it
+	completes
+	"""
+
+	acurs = async_conn.cursor()
+
+	set_guc(async_conn, 'max_parallel_workers_per_gather', num_workers)
+	set_guc(async_conn, 'parallel_setup_cost', 0)
+	set_guc(async_conn, 'parallel_tuple_cost', 0)
+	set_guc(async_conn, 'min_parallel_table_scan_size', 0)
+	acurs.execute(query)
+
+	pid = async_conn.get_backend_pid()
+	retry_while_running(async_conn, lambda: pg_query_state(config, pid))
+	result, notices = query_watch(config, pid, 1000, delay)
+	wait(async_conn)
+
+	for guc in ('parallel_setup_cost', 'parallel_tuple_cost', 'min_parallel_table_scan_size'):
+		acurs.execute('reset %s' % guc)
+		wait(async_conn)
+	return result, notices
+
+def onetime_query_watch(config, acon_query, acon_pg, query, ticks=2, delay=0.05):
+	"""
+	Watch progress of 'query' on connection 'acon_query' while query is
+	blocked after build of hash table
+	"""
+
+	curs_query = acon_query.cursor()
+	curs_pg = acon_pg.cursor()
+	curs_query.execute("select pg_advisory_lock(1);")
+	curs_pg.execute("select pg_advisory_lock(2);")
+	wait(acon_query)
+	wait(acon_pg)
+	curs_pg.execute("select pg_advisory_lock(1);")
+	set_guc(acon_query, 'enable_mergejoin', 'off')
+	set_guc(acon_query, 'max_parallel_workers_per_gather', 0)
+	curs_query.execute(query)
+	wait(acon_pg)
+
+	pid = acon_query.get_backend_pid()
+	retry_while_running(acon_query, lambda: pg_query_state(config, pid))
+	result, notices = query_watch(config, pid, ticks, delay)
+
+	curs_pg.execute("select pg_advisory_unlock(2);")
+	wait(acon_pg)
+	wait(acon_query)
+
+	set_guc(acon_query, 'enable_mergejoin', 'on')
+	curs_query.execute("select pg_advisory_unlock(2);")
+	wait(acon_query)
+	curs_pg.execute("select pg_advisory_unlock(1);")
+	wait(acon_pg)
+	return result, notices
+
+def misestimates(conn, pid, factor):
+	"""Get nodes of query whose rows exceed estimate by 'factor' times"""
+
+	curs = conn.cursor()
+	curs.execute("""select frame_number, plan_node_id, node_type, relid::regclass::text, relation, plan_rows,
+						   loops, actual_rows, rows_removed, misestimate
+					  from pg_query_state_misestimates(%s, %s)""", (pid, factor))
+	wait(conn)
+	return curs.fetchall()
+
+def query_misestimates_locks(config, acon_query, acon_pg, query, factors):
+	"""
+	Get misestimated nodes of 'query' on connection 'acon_query' blocked at the
+	same point, one list for each of 'factors'
+	"""
+
+	curs_query = acon_query.cursor()
+	curs_pg = acon_pg.cursor()
+	curs_query.execute("select pg_advisory_lock(1);")
+	curs_pg.execute("select pg_advisory_lock(2);")
+	wait(acon_query)
+	wait(acon_pg)
+	curs_pg.execute("select pg_advisory_lock(1);")
+	set_guc(acon_query, 'max_parallel_workers_per_gather', 0)
+	curs_query.execute(query)
+	wait(acon_pg)
+
+	pid = acon_query.get_backend_pid()
+	retry_while_running(acon_query, lambda: pg_query_state(config, pid))
+	results = [misestimates(acon_pg, pid, factor) for factor in factors]
+
+	curs_pg.execute("select pg_advisory_unlock(2);")
+	wait(acon_pg)
+	wait(acon_query)
+
+	curs_query.execute("select pg_advisory_unlock(2);")
+	wait(acon_query)
+	curs_pg.execute("select pg_advisory_unlock(1);")
+	wait(acon_pg)
+	return results
+
 def onetime_query_state(config, async_conn, query, args={}, num_workers=0):
 	"""
 	Get intermediate state of 'query' on connection 'async_conn' after number of 'steps'
@@ -137,25 +332,14 @@ def onetime_query_state(config, async_conn, query, args={}, num_workers=0):
 	acurs.execute(query)
 
 	# extract current state of query progress
-	MAX_PG_QS_RETRIES = 10
-	DELAY_BETWEEN_RETRIES = 0.1
 	pg_qs_args = {
 			'config': config,
 			'pid': async_conn.get_backend_pid()
 			}
 	for k, v in args.items():
 		pg_qs_args[k] = v
-	n_retries = 0
-	while True:
-		result, notices = pg_query_state(**pg_qs_args)
-		n_retries += 1
-		if len(result) > 0:
-			break
-		if n_retries >= MAX_PG_QS_RETRIES:
-			# pg_query_state callings don't return any result, more likely run
-			# query has completed
-			break
-		time.sleep(DELAY_BETWEEN_RETRIES)
+	result, notices = retry_while_running(async_conn,
+										  lambda: pg_query_state(**pg_qs_args))
 	wait(async_conn)
 
 	set_guc(async_conn, 'enable_mergejoin', 'on')
@@ -185,25 +369,14 @@ def onetime_progress_bar(config, async_conn, query, args={}, num_workers=0):
 	acurs.execute(query)
 
 	# extract progress of current query
-	MAX_PG_QS_RETRIES = 10
-	DELAY_BETWEEN_RETRIES = 0.1
 	pg_qs_args = {
 			'config': config,
 			'pid': async_conn.get_backend_pid(),
 			}
 	for k, v in args.items():
 		pg_qs_args[k] = v
-	n_retries = 0
-	while True:
-		result, notices = progress_bar(**pg_qs_args)
-		n_retries += 1
-		if len(result) > 0:
-			break
-		if n_retries >= MAX_PG_QS_RETRIES:
-			# pg_query_state callings don't return any result, more likely run
-			# query has completed
-			break
-		time.sleep(DELAY_BETWEEN_RETRIES)
+	result, notices = retry_while_running(async_conn,
+										  lambda: progress_bar(**pg_qs_args))
 	wait(async_conn)
 
 	set_guc(async_conn, 'enable_mergejoin', 'on')
@@ -0,0 +1,269 @@
+'''
+pg_qs_exporter.py
+Copyright (c) 2016-2025, Postgres Professional
+'''
+
+import argparse
+import getpass
+import hashlib
+import json
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import psycopg2
+
+LONG_RUNNING_QUERY = """
+	select pid, datname, usename, query
+	  from pg_stat_activity
+	 where state = 'active'
+	   and backend_type = 'client backend'
+	   and pid <> pg_backend_pid()
+	   and query_start < now() - make_interval(secs => %s)
+	 order by query_start
+	 limit %s
+	"""
+
+QUERY_STATE = """
+	select pid, frame_number, plan, leader_pid
+	  from pg_query_state(%s, costs := true, format := 'json', progress := true)
+	"""
+
+METRICS = [
+	('pg_qs_query_progress_ratio', 'gauge',
+		'Estimated fraction of the query plan already executed.'),
+	('pg_qs_query_node_rows', 'gauge',
+		'Rows produced so far by plan nodes of each type, summed over frames and workers.'),
+	('pg_qs_query_workers', 'gauge',
+		'Parallel workers currently running for the query.'),
+	('pg_qs_query_sample_duration_seconds', 'gauge',
+		'Time spent extracting the query state of the backend.'),
+	('pg_qs_sampled_backends', 'gauge',
+		'Long-running backends inspected during the last sampling cycle.'),
+	('pg_qs_sample_cycle_duration_seconds', 'gauge',
+		'Duration of the last sampling cycle.'),
+	('pg_qs_last_sample_timestamp_seconds', 'gauge',
+		'Unix time at which the last sampling cycle finished.'),
+	('pg_qs_sample_failures', 'counter',
+		'Query state extractions that failed since the exporter started.'),
+]
+
+class PasswordPromptAction(argparse.Action):
+	def __call__(self, parser, args, values, option_string=None):
+		password = getpass.getpass()
+		setattr(args, self.dest, password)
+
+def fingerprint(query):
+	''' Hash of query text with literals and whitespace normalized away '''
+	normalized = re.sub(r"'(?:[^']|'')*'", '?', query)
+	normalized = re.sub(r'\b\d+(?:\.\d+)?\b', '?', normalized)
+	normalized = re.sub(r'\s+', ' ', normalized).strip().lower()
+	return hashlib.md5(normalized.encode()).hexdigest()[:16]
+
+def node_rows(node):
+	''' Rows emitted by node in finished loops and in the current one '''
+	rows = node.get('Actual Rows', 0) * node.get('Actual Loops', 0)
+	rows += node.get('Current loop', {}).get('Actual Rows', 0)
+	return rows
+
+def walk_plan(node):
+	''' Iterate over plan node and all of its descendants '''
+	yield node
+	for subplan in node.get('Plans', []):
+		yield from walk_plan(subplan)
+
+def escape_label(value):
+	if value is None:
+		return ''
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels):
+	return '{' + ','.join('%s="%s"' % (k, escape_label(v)) for k, v in labels.items()) + '}'
+
+class Sampler:
+	'''
+	Periodically extracts state of long-running queries and keeps the metrics
+	rendered from the last snapshot. Scrapes only read the cached text, so the
+	rate of pg_query_state calls is bounded by 'interval' and 'max_backends'.
+	'''
+
+	def __init__(self, config, interval=15, min_duration=5, max_backends=10):
+		self.config = config
+		self.interval = interval
+		self.min_duration = min_duration
+		self.max_backends = max_backends
+		self.failures = 0
+		self.conn = None
+		self.lock = threading.Lock()
+		self.stop_event = threading.Event()
+		self.snapshot = self.render([], 0, 0)
+
+	def connect(self):
+		if self.conn is None or self.conn.closed:
+			self.conn = psycopg2.connect(**self.config)
+			self.conn.autocommit = True
+		return self.conn
+
+	def sample_backend(self, curs, pid, datname, usename, query):
+		''' Extract query state of one backend, return its metrics '''
+		start = time.monotonic()
+		curs.execute(QUERY_STATE, (pid,))
+		rows = curs.fetchall()
+		duration = time.monotonic() - start
+		if not rows:
+			return None
+
+		labels = {
+			'pid': pid,
+			'datname': datname,
+			'usename': usename,
+			'fingerprint': fingerprint(query),
+		}
+		progress = -1
+		rows_by_type = {}
+		workers = set()
+		for proc_pid, frame_number, plan_text, leader_pid in rows:
+			doc = json.loads(plan_text)
+			plan = doc['Plan']
+			if leader_pid is not None:
+				workers.add(proc_pid)
+			elif frame_number == 0:
+				progress = doc.get('Query Progress', -1)
+			for node in walk_plan(plan):
+				node_type = node['Node Type']
+				rows_by_type[node_type] = rows_by_type.get(node_type, 0) + node_rows(node)
+
+		return labels, progress, rows_by_type, len(workers), duration
+
+	def sample(self):
+		''' Run one sampling cycle and replace the cached snapshot '''
+		start = time.monotonic()
+		samples = []
+		try:
+			curs = self.connect().cursor()
+			curs.execute(LONG_RUNNING_QUERY, (self.min_duration, self.max_backends))
+			backends = curs.fetchall()
+		except psycopg2.Error:
+			self.failures += 1
+			self.conn = None
+			backends = []
+
+		for backend in backends:
+			try:
+				result = self.sample_backend(curs, *backend)
+			except (psycopg2.Error, ValueError, KeyError):
+				# backend may have finished its query in the meantime
+				self.failures += 1
+				continue
+			if result is not None:
+				samples.append(result)
+
+		snapshot = self.render(samples, len(backends), time.monotonic() - start)
+		with self.lock:
+			self.snapshot = snapshot
+
+	def render(self, samples, nbackends, cycle_duration):
+		'''
+		Render metrics both in Prometheus text exposition format and in
+		OpenMetrics format, the latter names counter families without suffix
+		'''
+		values = {name: [] for name, _, _ in METRICS}
+		for labels, progress, rows_by_type, nworkers, duration in samples:
+			if progress >= 0:
+				values['pg_qs_query_progress_ratio'].append((labels, progress))
+			for node_type, rows in sorted(rows_by_type.items()):
+				values['pg_qs_query_node_rows'].append((dict(labels, node_type=node_type), rows))
+			values['pg_qs_query_workers'].append((labels, nworkers))
+			values['pg_qs_query_sample_duration_seconds'].append((labels, duration))
+		values['pg_qs_sampled_backends'].append(({}, nbackends))
+		values['pg_qs_sample_cycle_duration_seconds'].append(({}, cycle_duration))
+		values['pg_qs_last_sample_timestamp_seconds'].append(({}, time.time()))
+		values['pg_qs_sample_failures'].append(({}, self.failures))
+
+		text, openmetrics = [], []
+		for name, metric_type, help_text in METRICS:
+			sample_name = name + '_total' if metric_type == 'counter' else name
+			for lines, family in ((text, sample_name), (openmetrics, name)):
+				lines.append('# HELP %s %s' % (family, help_text))
+				lines.append('# TYPE %s %s' % (family, metric_type))
+				for labels, value in values[name]:
+					lines.append('%s%s %s' % (sample_name, format_labels(labels) if labels else '', repr(float(value))))
+		return '\n'.join(text) + '\n', '\n'.join(openmetrics) + '\n# EOF\n'
+
+	def metrics(self, openmetrics=False):
+		''' Return cached metrics of the last sampling cycle '''
+		with self.lock:
+			return self.snapshot[1] if openmetrics else self.snapshot[0]
+
+	def run(self):
+		''' Sample until stopped, starting cycles no more often than 'interval' '''
+		while not self.stop_event.is_set():
+			start = time.monotonic()
+			self.sample()
+			self.stop_event.wait(max(0, self.interval - (time.monotonic() - start)))
+
+	def stop(self):
+		self.stop_event.set()
+
+class MetricsHandler(BaseHTTPRequestHandler):
+	sampler = None
+
+	def do_GET(self):
+		if self.path.split('?')[0] != '/metrics':
+			self.send_error(404)
+			return
+		openmetrics = 'application/openmetrics-text' in self.headers.get('Accept', '')
+		body = self.sampler.metrics(openmetrics)
+		if openmetrics:
+			content_type = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+		else:
+			content_type = 'text/plain; version=0.0.4; charset=utf-8'
+		data = body.encode()
+		self.send_response(200)
+		self.send_header('Content-Type', content_type)
+		self.send_header('Content-Length', str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+	def log_message(self, format, *args):
+		pass
+
+def main(config):
+	conn_params = {
+		key:config.__dict__[key] for key in ('host', 'port', 'user', 'database', 'password')
+	}
+
+	sampler = Sampler(conn_params, config.interval, config.min_duration, config.max_backends)
+	thread = threading.Thread(target=sampler.run, daemon=True)
+	thread.start()
+
+	MetricsHandler.sampler = sampler
+	server = ThreadingHTTPServer((config.listen_address, config.listen_port), MetricsHandler)
+	print('serving metrics on http://%s:%d/metrics' % (config.listen_address, config.listen_port))
+	sys.stdout.flush()
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		sampler.stop()
+		server.server_close()
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Prometheus exporter of query progress of running backends')
+
+	parser.add_argument('--host', default='localhost', help='postgres server host')
+	parser.add_argument('--port', type=int, default=5432, help='postgres server port')
+	parser.add_argument('--user', dest='user', default='postgres', help='user name')
+	parser.add_argument('--database', dest='database', default='postgres', help='database name')
+	parser.add_argument('--password', dest='password', nargs=0, action=PasswordPromptAction, default='', help='password')
+	parser.add_argument('--listen-address', dest='listen_address', default='0.0.0.0', help='address to serve metrics on')
+	parser.add_argument('--listen-port', dest='listen_port', type=int, default=9187, help='port to serve metrics on')
+	parser.add_argument('--interval', type=float, default=15, help='minimal number of seconds between sampling cycles')
+	parser.add_argument('--min-duration', dest='min_duration', type=float, default=5, help='sample only queries running longer than this number of seconds')
+	parser.add_argument('--max-backends', dest='max_backends', type=int, default=10, help='maximal number of backends sampled per cycle')
+
+	args = parser.parse_args()
+	main(args)
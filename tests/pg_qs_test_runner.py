@@ -5,8 +5,12 @@ Copyright (c) 2016-2025, Postgres Professional
 
 import argparse
 import getpass
+import multiprocessing
 import os
+import signal
 import sys
+import time
+import traceback
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(os.path.abspath('tmp/env'))
@@ -14,6 +18,7 @@ sys.path.append(os.path.abspath('tmp/env'))
 import psycopg2
 
 from test_cases import *
+import timing_bench
 import tpcds
 
 class PasswordPromptAction(argparse.Action):
@@ -23,6 +28,10 @@ class PasswordPromptAction(argparse.Action):
 
 class SetupException(Exception): pass
 class TeardownException(Exception): pass
+class TestTimeoutException(Exception): pass
+
+TEMPLATE_DB = 'pg_qs_template'
+TEST_DB = 'pg_qs_test_%d'
 
 unlock_if_eq_1 = """
 	CREATE OR REPLACE FUNCTION unlock_if_eq_1(x integer) RETURNS integer AS $$
@@ -52,17 +61,13 @@ setup_cmd = [
 	unlock_if_eq_1,
 ]
 
-teardown_cmd = [
-	'drop table foo cascade',
-	'drop table bar cascade',
-	'drop extension pg_query_state cascade',
-]
-
 tests = [
 	test_deadlock,
 	test_simple_query,
 	test_concurrent_access,
 	test_nested_call,
+	test_frame_selection,
+	test_depth_invisible_gather,
 	test_trigger,
 	test_costs,
 	test_buffers,
@@ -71,6 +76,15 @@ tests = [
 	test_timing_buffers_conflicts,
 	test_insert_on_conflict,
 	test_progress_bar,
+	test_exporter,
+	test_log_on_cancel,
+	test_timing_sampled,
+	test_memory,
+	test_progress,
+	test_progress_slot,
+	test_watch,
+	test_watch_parallel,
+	test_misestimates,
 ]
 
 def setup(con):
@@ -86,19 +100,122 @@ def setup(con):
 		raise SetupException('Setup failed: %s' % e)
 	print('done!')
 
-def teardown(con):
-	''' Drops table and extension '''
+def teardown(con, databases):
+	''' Drops databases created for tests '''
 	print('tearing down...')
 	try:
 		cur = con.cursor()
-		for cmd in teardown_cmd:
-			cur.execute(cmd)
-		con.commit()
+		for database in databases:
+			cur.execute('drop database if exists %s' % database)
 		cur.close()
 	except Exception as e:
 		raise TeardownException('Teardown failed: %s' % e)
 	print('done!')
 
+def database_exists(con, database):
+	cur = con.cursor()
+	cur.execute('select 1 from pg_database where datname = %s', (database,))
+	exists = cur.fetchone() is not None
+	cur.close()
+	return exists
+
+def create_template(con, conn_params, keep):
+	''' Builds database with test fixture to be cloned for each worker '''
+	cur = con.cursor()
+	if keep and database_exists(con, TEMPLATE_DB):
+		print('reusing template database %s' % TEMPLATE_DB)
+		return
+	cur.execute('drop database if exists %s' % TEMPLATE_DB)
+	cur.execute('create database %s' % TEMPLATE_DB)
+	cur.close()
+
+	template_conn = psycopg2.connect(**dict(conn_params, database=TEMPLATE_DB))
+	try:
+		setup(template_conn)
+	finally:
+		template_conn.close()
+
+def clone_template(con, n):
+	''' Creates n databases from template, returns their names '''
+	cur = con.cursor()
+	databases = []
+	for i in range(n):
+		database = TEST_DB % i
+		cur.execute('drop database if exists %s' % database)
+		cur.execute('create database %s template %s' % (database, TEMPLATE_DB))
+		databases.append(database)
+	cur.close()
+	return databases
+
+worker_config = None
+worker_timeout = None
+
+def init_worker(conn_params, databases, timeout):
+	''' Binds worker process to its own database '''
+	global worker_config, worker_timeout
+	worker_config = dict(conn_params, database=databases.get())
+	worker_timeout = timeout
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def on_timeout(signum, frame):
+	raise TestTimeoutException('test is running longer than %d s' % worker_timeout)
+
+def terminate_backends(config):
+	''' Terminates sessions that failed test left in worker database '''
+	conn = psycopg2.connect(**config)
+	conn.autocommit = True
+	cur = conn.cursor()
+	cur.execute("""select pg_terminate_backend(pid)
+					 from pg_stat_activity
+					where datname = current_database() and pid <> pg_backend_pid()""")
+	conn.close()
+
+def run_test(test):
+	''' Runs test case in worker, returns its name, error and duration '''
+	error = None
+	start = time.monotonic()
+	signal.signal(signal.SIGALRM, on_timeout)
+	signal.alarm(worker_timeout)
+	try:
+		test(worker_config)
+	except Exception:
+		error = traceback.format_exc()
+	finally:
+		signal.alarm(0)
+	duration = time.monotonic() - start
+
+	if error:
+		terminate_backends(worker_config)
+	return test.__name__, error, duration
+
+def describe(test):
+	if test.__doc__:
+		return test.__doc__
+	return 'test case %d' % (tests.index(test) + 1)
+
+def run_tests(conn_params, databases, jobs, timeout):
+	''' Runs test cases in pool of processes, returns number of failed ones '''
+	queue = multiprocessing.Queue()
+	for database in databases:
+		queue.put(database)
+
+	failed = []
+	start = time.monotonic()
+	by_name = {test.__name__: test for test in tests}
+	with multiprocessing.Pool(jobs, init_worker, (conn_params, queue, timeout)) as pool:
+		for name, error, duration in pool.imap_unordered(run_test, tests):
+			print('%s... %s (%.2f s)' % (describe(by_name[name]),
+										 'FAILED' if error else 'ok!', duration))
+			sys.stdout.flush()
+			if error:
+				failed.append((name, error))
+
+	for name, error in failed:
+		print('\n%s failed:\n%s' % (name, error))
+	print('%d of %d tests passed in %.2f s' % (len(tests) - len(failed), len(tests),
+											  time.monotonic() - start))
+	return len(failed)
+
 def main(config):
 	''' Main test function '''
 	conn_params = {
@@ -117,20 +234,25 @@ def main(config):
 		print('Stress finished successfully')
 		return
 
-	# run default tests
 	init_conn = psycopg2.connect(**conn_params)
-	setup(init_conn)
-	for i, test in enumerate(tests):
-		if test.__doc__:
-			descr = test.__doc__
-		else:
-			descr = 'test case %d' % (i+1)
-		print(("%s..." % descr))
-		sys.stdout.flush()
-		test(conn_params)
-		print('ok!')
-	teardown(init_conn)
+	init_conn.autocommit = True
+	create_template(init_conn, conn_params, config.keep_template)
+	databases = clone_template(init_conn, 1 if config.timing_bench else config.jobs)
+	created = databases if config.keep_template else databases + [TEMPLATE_DB]
+
+	if config.timing_bench:
+		print('Starting timing benchmark')
+		timing_bench.run_timing_bench(dict(conn_params, database=databases[0]))
+		teardown(init_conn, created)
+		init_conn.close()
+		return
+
+	# run default tests
+	failed = run_tests(conn_params, databases, config.jobs, config.timeout)
+	teardown(init_conn, created)
 	init_conn.close()
+	if failed:
+		sys.exit(1)
 
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser(description='Query state of running backends tests')
@@ -142,6 +264,10 @@ if __name__ == '__main__':
 	parser.add_argument('--password', dest='password', nargs=0, action=PasswordPromptAction, default='', help='password')
 	parser.add_argument('--tpc-ds-setup', dest='tpcds_setup', action='store_true', help='setup database to run TPC-DS benchmark')
 	parser.add_argument('--tpc-ds-run', dest='tpcds_run', action='store_true', help='run only stress test based on TPC-DS benchmark')
+	parser.add_argument('--timing-bench', dest='timing_bench', action='store_true', help='run only benchmark of timing overhead')
+	parser.add_argument('--jobs', type=int, default=1, help='number of test cases run concurrently')
+	parser.add_argument('--timeout', type=int, default=300, help='time limit of single test case in seconds')
+	parser.add_argument('--keep-template', dest='keep_template', action='store_true', help='reuse template database with test data left by previous run and keep it')
 
 	args = parser.parse_args()
 	main(args)
@@ -10,9 +10,11 @@ import time
 import xml.etree.ElementTree as ET
 
 import psycopg2
+import psycopg2.extensions
 import yaml
 
 import common
+import pg_qs_exporter
 
 def test_deadlock(config):
 	"""test when two backends try to extract state of each other"""
@@ -156,6 +158,92 @@ def test_nested_call(config):
 	util_conn.close()
 	common.n_close((acon1, acon2))
 
+def test_frame_selection(config):
+	"""test extraction of single frame and of plan subtree"""
+
+	acon1, acon2 = common.n_async_connect(config, 2)
+	util_conn = psycopg2.connect(**config)
+	util_curs = util_conn.cursor()
+	create_function = """
+		create or replace function n_join_foo_bar() returns integer as $$
+			begin
+				return (select count(*) from foo join bar on foo.c1=bar.c1 and unlock_if_eq_1(foo.c1)=bar.c1);
+			end;
+		$$ language plpgsql"""
+	drop_function = 'drop function n_join_foo_bar()'
+	call_function = 'select * from n_join_foo_bar()'
+	query = 'select count(*) from foo join bar on foo.c1=bar.c1 and unlock_if_eq_1(foo.c1)=bar.c1'
+	expected_outermost = 'Function Scan on n_join_foo_bar (Current loop: actual rows=0, loop number=1)'
+	expected_subtree = r"""Hash \(Current loop: actual rows=500000, loop number=1\)
+  Buckets: \d+  Batches: \d+  Memory Usage: \d+kB
+  ->  Seq Scan on bar \(Current loop: actual rows=\d+, loop number=1\)$"""
+	expected_pruned = r"""Hash \(Current loop: actual rows=500000, loop number=1\)
+  Buckets: \d+  Batches: \d+  Memory Usage: \d+kB$"""
+
+	util_curs.execute(create_function)
+	util_conn.commit()
+
+	qs, notices = common.onetime_query_state_locks(config, acon1, acon2, call_function)
+	assert len(qs) >= 2
+	innermost = qs[-1]
+
+	qs, notices = common.onetime_query_state_locks(config, acon1, acon2, call_function,
+												   {'frame': 'outermost'})
+	assert len(qs) == 1
+	assert qs[0][1] == 0
+	assert qs[0][3] == expected_outermost
+
+	for frame in ('innermost', str(innermost[1])):
+		qs, notices = common.onetime_query_state_locks(config, acon1, acon2, call_function,
+													   {'frame': frame})
+		assert len(qs) == 1
+		assert qs[0][1] == innermost[1]
+		assert qs[0][2] == innermost[2]
+		assert len(notices) == 0
+
+	util_curs.execute(drop_function)
+	util_conn.commit()
+
+	# plan is Aggregate(0) -> Hash Join(1) -> Seq Scan on foo(2), Hash(3) -> Seq Scan on bar(4)
+	qs, notices = common.onetime_query_state_locks(config, acon1, acon2, query, {'node_id': 3})
+	assert len(qs) == 1
+	assert re.match(expected_subtree, qs[0][3])
+	assert len(notices) == 0
+
+	if acon1.server_version >= 130000:
+		qs, notices = common.onetime_query_state_locks(config, acon1, acon2, query,
+													   {'node_id': 3, 'depth': 0})
+		assert len(qs) == 1
+		assert re.match(expected_pruned, qs[0][3])
+		assert len(notices) == 0
+
+	util_conn.close()
+	common.n_close((acon1, acon2))
+
+def test_depth_invisible_gather(config):
+	"""test depth limit of plan under invisible Gather of debug_parallel_query"""
+
+	acon, = common.n_async_connect(config)
+	query = 'select count(*) from (select pg_sleep(1) from generate_series(1, 2)) s'
+
+	if acon.server_version < 130000:
+		common.n_close((acon,))
+		return
+
+	if acon.server_version >= 160000:
+		common.set_guc(acon, 'debug_parallel_query', 'on')
+	else:
+		common.set_guc(acon, 'force_parallel_mode', 'on')
+
+	# plan is invisible Gather -> Aggregate -> Function Scan, and only
+	# Aggregate is printed at depth 0
+	qs, notices = common.onetime_query_state(config, acon, query, {'depth': 0}, num_workers=2)
+	assert len(qs) >= 1
+	assert re.match(r'Aggregate \(.*\)$', qs[0][3])
+	assert len(notices) == 0
+
+	common.n_close((acon,))
+
 def test_insert_on_conflict(config):
 	"""test statistics on conflicting tuples under INSERT ON CONFLICT query"""
 
@@ -316,6 +404,172 @@ def test_timing(config):
 
 	common.n_close((acon1, acon2))
 
+def test_timing_sampled(config):
+	"""test sampled timing statistics"""
+
+	acon1, acon2 = common.n_async_connect(config, 2)
+	query = 'select count(*) from foo join bar on foo.c1=bar.c1 and unlock_if_eq_1(foo.c1)=bar.c1'
+
+	expected = r"""Aggregate \(Current loop: running time=\d+.\d+ actual rows=0, loop number=1\)
+  ->  Hash Join \(Current loop: actual time=\d+.\d+..\d+.\d+ rows=\d+, loop number=1\)
+        Hash Cond: \(foo.c1 = bar.c1\)
+        Join Filter: \(unlock_if_eq_1\(foo.c1\) = bar.c1\)
+        ->  Seq Scan on foo \(Current loop: actual time=\d+.\d+..\d+.\d+ rows=\d+, loop number=1\)
+        ->  Hash \(Current loop: actual time=\d+.\d+..\d+.\d+ rows=500000, loop number=1\)
+              Buckets: \d+  Batches: \d+  Memory Usage: \d+kB
+              ->  Seq Scan on bar \(Current loop: actual time=\d+.\d+..\d+.\d+ rows=\d+, loop number=1\)
+Timing Mode: sampled every 100 rows, estimated$"""
+
+	common.set_guc(acon1, 'pg_query_state.enable_timing', 'on')
+	common.set_guc(acon1, 'pg_query_state.timing_sample_rate', 100)
+
+	qs, notices = common.onetime_query_state_locks(config, acon1, acon2, query, {'timing': True})
+
+	assert len(qs) == 2
+	assert re.match(expected, qs[0][3])
+	assert len(notices) == 0
+
+	# Aggregate is inside of its first call, which has built the hash table
+	running_time = re.match(r'Aggregate \(Current loop: running time=(\d+.\d+)', qs[0][3])
+	assert float(running_time.group(1)) > 0
+
+	# sampling isn't reported when timing isn't requested
+	qs, notices = common.onetime_query_state_locks(config, acon1, acon2, query)
+
+	assert len(qs) == 2
+	assert 'Timing Mode' not in qs[0][3]
+
+	common.n_close((acon1, acon2))
+
+def test_memory(config):
+	"""test memory usage of running plan nodes"""
+
+	acon1, acon2 = common.n_async_connect(config, 2)
+	query = 'select count(*) from foo join bar on foo.c1=bar.c1 and unlock_if_eq_1(foo.c1)=bar.c1'
+
+	expected = r"""Memory:
+(  Executor Memory: \d+ kB
+)?  Hash \(node 3\):
+    Memory Usage: \d+ kB
+    Peak Memory Usage: \d+ kB
+    Hash Buckets: \d+
+    Hash Batches: \d+
+    Original Hash Batches: \d+$"""
+
+	qs, notices = common.onetime_query_state_locks(config, acon1, acon2, query, {'memory': True})
+	assert len(qs) == 1
+	assert re.search(expected, qs[0][3])
+	assert len(notices) == 0
+
+	qs, notices = common.onetime_query_state_locks(config, acon1, acon2, query,
+												   {'memory': True, 'format': 'json'})
+	assert len(qs) == 1
+	memory = json.loads(qs[0][3])['Memory']
+	if acon1.server_version >= 130000:
+		assert memory['Executor Memory'] > 0
+	assert len(memory['Nodes']) == 1
+	hash_node = memory['Nodes'][0]
+	assert hash_node['Node Type'] == 'Hash' and hash_node['Plan Node Id'] == 3
+	assert hash_node['Memory Usage'] > 0 and hash_node['Hash Batches'] >= 1
+	assert len(notices) == 0
+
+	common.n_close((acon1, acon2))
+
+def test_progress(config):
+	"""test progress and scanned blocks of query blocked after build of hash table"""
+
+	acon1, acon2 = common.n_async_connect(config, 2)
+	query = 'select count(*) from foo join bar on foo.c1=bar.c1 and unlock_if_eq_1(foo.c1)=bar.c1'
+
+	qs, notices = common.onetime_query_state_locks(config, acon1, acon2, query, {'progress': True})
+	assert len(qs) == 1
+	assert re.search(r'^Query Progress: 0\.\d{6}$', qs[0][3], re.MULTILINE)
+	assert len(notices) == 0
+
+	qs, notices = common.onetime_query_state_locks(config, acon1, acon2, query,
+												   {'progress': True, 'format': 'json'})
+	assert len(qs) == 1
+	plan = json.loads(qs[0][3])
+	# inner side of join is hashed completely, outer one is just started
+	assert 0 < plan['Query Progress'] < 1
+	assert plan['Rows Processed'] > 0
+	assert len(plan['Scans']) == 2
+	for scan in plan['Scans']:
+		assert scan['Node Type'] == 'Seq Scan'
+		assert 0 < scan['Heap Blocks Scanned'] <= scan['Heap Blocks']
+	assert len(notices) == 0
+
+	common.n_close((acon1, acon2))
+
+def test_progress_slot(config):
+	"""test progress published by backend to shared memory"""
+
+	acon1, acon2 = common.n_async_connect(config, 2)
+	query = 'select count(*) from foo join bar on foo.c1=bar.c1 and unlock_if_eq_1(foo.c1)=bar.c1'
+
+	running, finished = common.onetime_query_progress(config, acon1, acon2, query)
+	assert len(running) == 1
+	progress, workers, node_ids, node_rows = running[0]
+	assert 0 < progress < 1
+	assert workers == 0
+	assert node_ids == [0, 1, 2, 3, 4]
+	assert len(node_rows) == len(node_ids)
+	# slot is cleared when query is finished
+	assert len(finished) == 0
+
+	common.n_close((acon1, acon2))
+
+def test_watch(config):
+	"""test periodic capture of query progress by pg_query_state_watch"""
+
+	acon1, acon2 = common.n_async_connect(config, 2)
+	query = 'select count(*) from foo join bar on foo.c1=bar.c1 and unlock_if_eq_1(foo.c1)=bar.c1'
+
+	ticks, notices = common.onetime_query_watch(config, acon1, acon2, query)
+	assert len(ticks) == 2 and len(notices) == 0
+	(ts1, progress1, rows1, rate1, workers1), (ts2, progress2, rows2, rate2, _) = ticks
+	assert ts1 < ts2
+	assert 0 < progress1 <= progress2 < 1
+	assert 0 < rows1 <= rows2
+	# rate is known since the second tick, query is blocked meanwhile
+	assert rate1 is None and rate2 == 0
+	assert workers1 == 0
+
+	common.n_close((acon1, acon2))
+
+def test_watch_parallel(config):
+	"""test that rows passed from workers to leader are counted once"""
+
+	acon, = common.n_async_connect(config)
+	# ten rows are found by all participants together, slowly
+	query = 'select c1 from foo where c1 % 100000 = 0 and pg_sleep(0.3) is not null'
+
+	ticks, notices = common.query_watch_parallel(config, acon, query, 2)
+	assert len(ticks) > 0 and len(notices) == 0
+	assert any(workers > 0 for _, _, _, _, workers in ticks)
+	for _, _, rows, _, _ in ticks:
+		assert rows <= 10
+
+	common.n_close((acon,))
+
+def test_misestimates(config):
+	"""test ranking of nodes by excess of actual rows over estimated ones"""
+
+	acon1, acon2 = common.n_async_connect(config, 2)
+	# filter is estimated to pass one row, scan is blocked after 100000 ones
+	query = 'select count(*) from foo where abs(c1) = c1 and unlock_if_eq_1(c1 - 100000) = c1 - 100000'
+
+	found, not_found = common.query_misestimates_locks(config, acon1, acon2, query, [100, 1e9])
+	assert len(found) == 1
+	frame, node_id, node_type, relid, relation, plan_rows, loops, rows, removed, misestimate = found[0]
+	assert frame == 0 and node_id == 1
+	assert node_type == 'Seq Scan' and relid == 'foo' and relation == 'foo'
+	assert loops == 1 and removed == 0
+	assert rows >= 100 * plan_rows and misestimate == rows / max(plan_rows, 1)
+	assert len(not_found) == 0
+
+	common.n_close((acon1, acon2))
+
 def check_plan(plan):
 	assert 'Current loop' in plan
 	cur_loop = plan['Current loop']
@@ -423,3 +677,62 @@ def test_progress_bar(config):
 	assert qs[0][0] >= first_qs and qs[0][0] < 1
 
 	common.n_close((acon,))
+
+def test_log_on_cancel(config):
+	"""test capture of query state on statement timeout"""
+
+	acon, = common.n_async_connect(config)
+	acurs = acon.cursor()
+	query = 'select count(*) from foo cross join bar'
+
+	for fmt in ('text', 'json'):
+		common.set_guc(acon, 'pg_query_state.log_on_cancel', fmt)
+		common.set_guc(acon, 'pg_query_state.log_on_cancel_max_size', "'1kB'")
+		common.set_guc(acon, 'statement_timeout', 100)
+		acurs.execute(query)
+		try:
+			common.wait(acon)
+			assert False, 'Query should be canceled by statement timeout'
+		except psycopg2.extensions.QueryCanceledError:
+			pass
+		assert len(acon.notices) == 0
+
+	common.set_guc(acon, 'statement_timeout', 0)
+	common.set_guc(acon, 'pg_query_state.log_on_cancel', 'off')
+	acurs.execute('select 1')
+	common.wait(acon)
+	assert acurs.fetchone() == (1,)
+
+	common.n_close((acon,))
+
+def test_exporter(config):
+	"""test metrics of the exporter sampling running query"""
+
+	acon, = common.n_async_connect(config)
+	acurs = acon.cursor()
+	query = 'select count(*) from foo join bar on foo.c1=bar.c1'
+	pid = acon.get_backend_pid()
+	pid_label = 'pid="%d"' % pid
+
+	# backends of concurrently running tests are sampled too
+	sampler = pg_qs_exporter.Sampler(config, interval=0, min_duration=0, max_backends=100)
+	common.set_guc(acon, 'max_parallel_workers_per_gather', 0)
+	acurs.execute(query)
+
+	MAX_RETRIES = 10
+	for _ in range(MAX_RETRIES):
+		sampler.sample()
+		metrics = sampler.metrics()
+		if pid_label in metrics:
+			break
+	common.wait(acon)
+
+	assert pid_label in metrics
+	assert re.search(r'pg_qs_query_progress_ratio\{[^}]*%s[^}]*\} \d+\.\d+' % pid_label, metrics)
+	assert re.search(r'pg_qs_query_node_rows\{[^}]*%s[^}]*node_type="Seq Scan"\} ' % pid_label, metrics)
+	assert re.search(r'pg_qs_query_workers\{[^}]*%s[^}]*\} 0\.0' % pid_label, metrics)
+	assert 'pg_qs_sample_failures_total ' in metrics
+	assert sampler.metrics(openmetrics=True).endswith('# EOF\n')
+
+	sampler.conn.close()
+	common.n_close((acon,))
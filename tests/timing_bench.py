@@ -0,0 +1,62 @@
+'''
+timing_bench.py
+Copyright (c) 2016-2025, Postgres Professional
+'''
+
+import statistics
+import time
+
+import psycopg2
+
+QUERIES = [
+	'select count(*) from foo',
+	'select count(*) from foo join bar on foo.c1 = bar.c1',
+	'select c2, count(*) from bar group by c2',
+]
+
+MODES = [
+	('no timing', {'pg_query_state.enable_timing': 'off'}),
+	('full timing', {'pg_query_state.enable_timing': 'on',
+					 'pg_query_state.timing_sample_rate': '0'}),
+	('sampled 1/100', {'pg_query_state.enable_timing': 'on',
+					   'pg_query_state.timing_sample_rate': '100'}),
+	('sampled 1/1000', {'pg_query_state.enable_timing': 'on',
+						'pg_query_state.timing_sample_rate': '1000'}),
+]
+
+def run_query(curs, query, runs):
+	''' Execute query several times, return median duration in ms '''
+	durations = []
+	for _ in range(runs):
+		start = time.perf_counter()
+		curs.execute(query)
+		curs.fetchall()
+		durations.append((time.perf_counter() - start) * 1000)
+	return statistics.median(durations)
+
+def run_timing_bench(config, runs=5):
+	"""benchmark of query overhead without timing, with full and sampled timing"""
+
+	conn = psycopg2.connect(**config)
+	conn.autocommit = True
+	curs = conn.cursor()
+	curs.execute('set max_parallel_workers_per_gather = 0')
+
+	for query in QUERIES:
+		print(query)
+		baseline = None
+		for name, gucs in MODES:
+			for param, value in gucs.items():
+				curs.execute('set %s = %s' % (param, value))
+			# warm up caches before measuring
+			run_query(curs, query, 1)
+			duration = run_query(curs, query, runs)
+			if baseline is None:
+				baseline = duration
+			print('  %-16s %10.1f ms  %+7.1f%%' % (name, duration,
+												  (duration / baseline - 1) * 100))
+		curs.execute('reset pg_query_state.enable_timing')
+		curs.execute('reset pg_query_state.timing_sample_rate')
+
+	curs.close()
+	conn.close()